@@ -10,6 +10,7 @@ import logging.config
 
 UI_SIZE = (900, 600)
 LOG_FILE = 'anam-desktop.log'
+DATA_DIR = 'anam-desktop-data'
 HELP_FILE = "Aide ANAM Desktop.pdf"
 IS_MAC = platform.system() == 'Darwin'
 SETTINGS_FILE = "anam-desktop.settings"
@@ -76,6 +77,26 @@ def read_settings(filename):
         'picserv_password': None,
         'picserv_share': "partage_images",
         'picserv_name': "SERVEUR_APPL",
+        'picserv_workers': 4,
+        'picserv_backend': "smb",  # or `local` (tests/benchmarks)
+        'picserv_local_root': None,
+        'picserv_local_latency': 0,
+        'picserv_local_failure_rate': 0,
+        'picserv_local_unavailable_rate': 0,
+        'copy_skip_unchanged': True,
+        'copy_check_hash': False,
+        'copy_queue_size': 16,
+        'copy_verify': True,
+        'copy_verify_sample': 0.05,  # ratio of files read back
+        'copy_recompress': False,
+        'copy_max_dimension': 2048,
+        'copy_jpeg_quality': 80,
+        'copy_recompress_min_size': 512 * 1024,
+        'copy_recompress_workers': 0,  # number of CPUs
+        'copy_dedup': "copy",  # identical images: `copy`, `skip` or None
+        'usb_scan_workers': 4,
+        'usb_check_integrity': True,
+        'usb_reject_ratio': 0.2,  # reject source if more files are bad
 
         'db_serverip': "192.168.1.11",
         'db_username': "anam_mobile",
@@ -84,6 +105,23 @@ def read_settings(filename):
 
         'store_url': "http://192.168.1.10:8080",
         'store_token': None,
+        'store_pool_size': 4,
+        'store_connect_timeout': 5,
+        'store_read_timeout': 30,
+        'store_gzip_level': 0,  # 1-9 only if receiver decodes gzip bodies
+        'store_gzip_min_size': 1024,
+        'collects_refresh_interval': 60,
+        'upload_chunk_size': 0,
+
+        'retry_max_attempts': 4,
+        'retry_base_delay': 0.5,
+        'retry_max_delay': 8,
+        'retry_budget': 20,
+
+        'breaker_ttl': 30,
+        'breaker_reset_timeout': 10,
+
+        'cache_max_size': 500 * 1024 * 1024,
     }
     try:
         with open(filename, 'r') as f:
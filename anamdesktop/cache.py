@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import json
+import time
+import threading
+
+from anamdesktop import logger, SETTINGS, DATA_DIR
+from anamdesktop import jsonstream
+from anamdesktop.network import do_download
+
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+INDEX_FNAME = 'index.json'
+
+
+class DatasetCache(object):
+    ''' on-disk cache of collect datasets, keyed by collect ID
+
+        entries are revalidated against anam-receiver using ETag or
+        Last-Modified (conditional GET) or skip the request altogether
+        if the caller knows the collect's `updated_on` is unchanged
+        (unless `expire()`d since).
+        least-recently-used entries are evicted above `max_size` bytes. '''
+
+    def __init__(self, folder=CACHE_DIR, max_size=None):
+        self.folder = folder
+        self.max_size = int(max_size if max_size is not None
+                            else SETTINGS.get('cache_max_size'))
+        self.lock = threading.RLock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.index = self.read_index()
+
+    @property
+    def index_fpath(self):
+        return os.path.join(self.folder, INDEX_FNAME)
+
+    def read_index(self):
+        try:
+            with open(self.index_fpath, 'r') as f:
+                index = json.load(f)
+        except Exception:
+            return {}
+
+        # drop entries which file has vanished
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(self.get_fpath(key))}
+
+    def save_index(self):
+        try:
+            with open(self.index_fpath, 'w') as f:
+                json.dump(self.index, f, indent=4)
+        except Exception as exp:
+            logger.error("Unable to save cache index")
+            logger.exception(exp)
+
+    def get_fpath(self, collect_id):
+        return os.path.join(self.folder, "collect-{}.json".format(collect_id))
+
+    def get_validators(self, collect_id):
+        ''' conditional request headers for cached `collect_id` '''
+        entry = self.index.get(str(collect_id))
+        if entry is None:
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @property
+    def size(self):
+        return sum([entry.get('size', 0) for entry in self.index.values()])
+
+    def evict(self, keep=None):
+        ''' remove least recently used entries until under `max_size`
+
+            `keep` (key) is never evicted as it's being used '''
+        candidates = sorted([key for key in self.index.keys() if key != keep],
+                            key=lambda k: self.index[k].get('accessed', 0))
+        while self.size > self.max_size and candidates:
+            key = candidates.pop(0)
+            logger.info("Evicting dataset #{} from cache".format(key))
+            try:
+                os.remove(self.get_fpath(key))
+            except OSError as exp:
+                logger.exception(exp)
+            del self.index[key]
+
+    def expire(self, collect_id):
+        ''' revalidate `collect_id` on next use whatever its `updated_on`
+
+            for after a change made from here (known `updated_on` lags) '''
+        with self.lock:
+            entry = self.index.get(str(collect_id))
+            if entry is None or entry.get('updated_on') is None:
+                return
+            entry['updated_on'] = None
+            self.save_index()
+
+    def get_dataset(self, collect_id, lazy=None, updated_on=None,
+                    count_by=None):
+        ''' `/collects/{id}` response as JSON, from cache when valid
+
+            see. `do_download()` for `lazy` and `count_by` '''
+        key = str(collect_id)
+        fpath = self.get_fpath(key)
+
+        with self.lock:
+            entry = self.index.get(key)
+            headers = self.get_validators(key)
+            if entry is not None and updated_on is not None \
+                    and entry.get('updated_on') == updated_on:
+                headers = None
+
+            meta = {}
+            if headers is None:
+                logger.info("Dataset #{} fresh in cache".format(key))
+                resp = jsonstream.load(fpath, lazy=lazy, count_by=count_by)
+            else:
+                resp = do_download('/collects/{}'.format(collect_id), fpath,
+                                   lazy=lazy, headers=headers, meta=meta,
+                                   count_by=count_by)
+                if meta.get('status_code') == 304:
+                    logger.info("Dataset #{} not modified. Using cache."
+                                .format(key))
+
+            entry = entry or {}
+            self.index[key] = {
+                'etag': meta.get('etag') or entry.get('etag'),
+                'last_modified': meta.get('last_modified')
+                or entry.get('last_modified'),
+                'updated_on': updated_on or entry.get('updated_on'),
+                'size': os.path.getsize(fpath),
+                'accessed': time.time(),
+            }
+            self.evict(keep=key)
+            self.save_index()
+            return resp
+
+
+_cache = None
+
+
+def get_cache():
+    ''' shared `DatasetCache` instance '''
+    global _cache
+    if _cache is None:
+        _cache = DatasetCache()
+    return _cache
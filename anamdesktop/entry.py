@@ -7,11 +7,15 @@ import sys
 from PyQt5 import QtWidgets, QtCore
 
 from anamdesktop import setlocale, logger
+from anamdesktop.network import close_clients
+from anamdesktop.samba import close_sessions
 from anamdesktop.ui.main import MainWindow
 
 
 def destroy():
     logger.info("Exiting Application")
+    close_clients()
+    close_sessions()
     QtCore.QCoreApplication.instance().quit
     sys.exit(0)
 
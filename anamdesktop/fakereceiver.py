@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' local stand-in for anam-receiver, backed by fixture files
+
+    serves the API used by anam-desktop so that network paths can be
+    tested and benchmarked without a live receiver.
+
+    fixtures folder:
+        - collects.json: list of collects (as in /api/collects)
+        - collect-{id}.json: a full collect (as in /api/collects/{id})
+
+    python -m anamdesktop.fakereceiver fixtures/ --latency 0.05 '''
+
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import hashlib
+import argparse
+import binascii
+import datetime
+import threading
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from anamdesktop import logger
+
+CHUNK_SIZE = 16 * 1024
+
+
+def now_iso():
+    return datetime.datetime.utcnow().isoformat() + "Z"
+
+
+class FakeReceiverState(object):
+    ''' in-memory collects (loaded from fixtures) and transfer counters '''
+
+    def __init__(self, fixtures_dir=None, token=None, latency=0,
+                 bandwidth=None, failure_rate=0):
+        self.fixtures_dir = fixtures_dir
+        self.token = token
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.collects = self.load_collects()
+        self.uploads = []
+        self.chunked_uploads = {}
+        self.idempotency_keys = {}
+        self.stats = {'requests': 0, 'failures': 0,
+                      'bytes_in': 0, 'bytes_out': 0}
+
+    def load_collects(self):
+        if not self.fixtures_dir:
+            return {}
+        with open(os.path.join(self.fixtures_dir, 'collects.json')) as f:
+            return {str(collect['id']): collect for collect in json.load(f)}
+
+    def get_collect_fpath(self, collect_id):
+        return os.path.join(self.fixtures_dir,
+                            "collect-{}.json".format(collect_id))
+
+    def get_collect(self, collect_id):
+        ''' full collect: fixture file updated with in-memory state '''
+        with open(self.get_collect_fpath(collect_id)) as f:
+            collect = json.load(f)
+        collect.update(self.collects[str(collect_id)])
+        return collect
+
+    def update_collect(self, collect_id, **fields):
+        with self.lock:
+            fields['updated_on'] = now_iso()
+            self.collects[str(collect_id)].update(fields)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+
+class FakeReceiverHandler(BaseHTTPRequestHandler):
+    ''' anam-receiver API endpoints '''
+
+    protocol_version = 'HTTP/1.1'
+
+    POST_ROUTES = [
+        (re.compile(r'^/api/collects/(\d+)/archive/?$'), 'archive'),
+        (re.compile(r'^/api/collects/(\d+)/unarchive/?$'), 'unarchive'),
+        (re.compile(r'^/api/collects/(\d+)/mark_imported/?$'),
+         'mark_imported'),
+        (re.compile(r'^/api/collects/(\d+)/mark_images_copied/?$'),
+         'mark_images_copied'),
+        (re.compile(r'^/api/upload/?$'), 'upload'),
+        (re.compile(r'^/api/upload/chunked/?$'), 'chunked_start'),
+        (re.compile(r'^/api/upload/chunked/(\w+)/parts/(\d+)/?$'),
+         'chunked_part'),
+        (re.compile(r'^/api/upload/chunked/(\w+)/complete/?$'),
+         'chunked_complete'),
+    ]
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        logger.debug("fakereceiver: " + format % args)
+
+    def send_body(self, body, status=200, headers=None):
+        ''' sends `body` (bytes) throttled to bandwidth, gzip if accepted '''
+        headers = dict(headers or {})
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = "gzip"
+        headers['Content-Length'] = str(len(body))
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        for index in range(0, len(body), CHUNK_SIZE):
+            chunk = body[index:index + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.state.bandwidth:
+                time.sleep(len(chunk) / self.state.bandwidth)
+        self.state.count('bytes_out', len(body))
+
+    def send_json(self, data, status=200, headers=None):
+        self.send_body(json.dumps(data).encode('utf-8'), status, headers)
+
+    def send_error_json(self, status, message):
+        self.send_json({'status': 'error', 'message': message}, status)
+
+    def read_body(self):
+        ''' request body (bytes, decompressed) or None '''
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        body = self.rfile.read(length)
+        if self.state.bandwidth:
+            time.sleep(length / self.state.bandwidth)
+        self.state.count('bytes_in', length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def preprocess(self):
+        ''' injected latency, failures and auth. False if already replied '''
+        self.state.count('requests')
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        if random.random() < self.state.failure_rate:
+            self.state.count('failures')
+            self.read_body()
+            self.send_error_json(503, "injected failure")
+            return False
+
+        if self.state.token and self.headers.get('Authorization') \
+                != "Token {}".format(self.state.token):
+            self.read_body()
+            self.send_error_json(401, "invalid token")
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.preprocess():
+            return
+
+        path, _, query = self.path.partition('?')
+
+        if path.rstrip('/') == '/api/check':
+            return self.send_json({'status': 'success'})
+
+        if path.rstrip('/') == '/api/collects':
+            collects = list(self.state.collects.values())
+            match = re.search(r'updated_since=([^&]+)', query)
+            if match:
+                collects = [collect for collect in collects
+                            if collect.get('updated_on', '')
+                            > match.group(1)]
+            return self.send_json({'status': 'success',
+                                   'delta': bool(match),
+                                   'collects': collects})
+
+        match = re.match(r'^/api/upload/chunked/(\w+)/?$', path)
+        if match and match.group(1) in self.state.chunked_uploads:
+            upload = self.state.chunked_uploads[match.group(1)]
+            return self.send_json({'status': 'success',
+                                   'received': sorted(upload['parts'])})
+
+        match = re.match(r'^/api/collects/(\d+)/?$', path)
+        if match and match.group(1) in self.state.collects:
+            body = json.dumps({'status': 'success',
+                               'collect': self.state.get_collect(
+                                   match.group(1))}).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_body(b'', 304, {'ETag': etag})
+            return self.send_body(body, headers={'ETag': etag})
+
+        self.send_error_json(404, "not found")
+
+    def do_POST(self):
+        if not self.preprocess():
+            return
+
+        body = self.read_body()
+        payload = json.loads(body.decode('utf-8')) if body else None
+
+        # replay response of an already processed request
+        key = self.headers.get('Idempotency-Key')
+        if key and key in self.state.idempotency_keys:
+            return self.send_json(self.state.idempotency_keys[key])
+
+        for regexp, action in self.POST_ROUTES:
+            match = regexp.match(self.path)
+            if match is None:
+                continue
+            args = match.groups()
+            if regexp.pattern.startswith('^/api/collects/') \
+                    and args[0] not in self.state.collects:
+                break
+            resp = getattr(self, 'post_{}'.format(action))(payload, *args)
+            if resp.get('status') != 'success':
+                return self.send_json(resp, 400)
+            if key:
+                self.state.idempotency_keys[key] = resp
+            return self.send_json(resp)
+
+        self.send_error_json(404, "not found")
+
+    def post_archive(self, payload, collect_id):
+        self.state.update_collect(collect_id, archived=True)
+        return {'status': 'success'}
+
+    def post_unarchive(self, payload, collect_id):
+        self.state.update_collect(collect_id, archived=False)
+        return {'status': 'success'}
+
+    def post_mark_imported(self, payload, collect_id):
+        self.state.update_collect(collect_id, imported=True,
+                                  imported_on=now_iso(),
+                                  can_be_imported=False,
+                                  can_be_copied=True,
+                                  targets=payload or {})
+        return {'status': 'success'}
+
+    def post_mark_images_copied(self, payload, collect_id):
+        payload = payload or {}
+        self.state.update_collect(
+            collect_id, images_copied=True, images_copied_on=now_iso(),
+            images_nb_total=payload.get('images_nb_total'),
+            images_nb_error=payload.get('images_nb_error'))
+        return {'status': 'success'}
+
+    def post_upload(self, payload):
+        with self.state.lock:
+            self.state.uploads.append(payload)
+        return {'status': 'success'}
+
+    def post_chunked_start(self, payload):
+        upload_id = binascii.hexlify(os.urandom(8)).decode()
+        with self.state.lock:
+            self.state.chunked_uploads[upload_id] = {
+                'meta': payload['meta'],
+                'nb_parts': payload['nb_parts'],
+                'nb_targets': payload['nb_targets'],
+                'parts': {}}
+        return {'status': 'success', 'upload_id': upload_id}
+
+    def post_chunked_part(self, payload, upload_id, number):
+        upload = self.state.chunked_uploads.get(upload_id)
+        if upload is None:
+            return {'status': 'error', 'message': "unknown upload"}
+        checksum = hashlib.sha256(json.dumps(
+            payload['targets'], sort_keys=True).encode('utf-8')).hexdigest()
+        if checksum != payload.get('checksum'):
+            return {'status': 'error', 'message': "checksum mismatch"}
+        with self.state.lock:
+            upload['parts'][int(number)] = payload['targets']
+        return {'status': 'success', 'part': int(number)}
+
+    def post_chunked_complete(self, payload, upload_id):
+        upload = self.state.chunked_uploads.get(upload_id)
+        if upload is None or len(upload['parts']) != upload['nb_parts']:
+            return {'status': 'error', 'message': "missing parts"}
+        targets = []
+        for number in range(upload['nb_parts']):
+            targets += upload['parts'][number]
+        if len(targets) != upload['nb_targets']:
+            return {'status': 'error', 'message': "missing targets"}
+        with self.state.lock:
+            self.state.uploads.append(dict(upload['meta'], targets=targets))
+            del self.state.chunked_uploads[upload_id]
+        return {'status': 'success'}
+
+
+class FakeReceiver(socketserver.ThreadingMixIn, HTTPServer):
+    ''' threaded HTTP server holding a `FakeReceiverState` '''
+
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        super().__init__(address, FakeReceiverHandler)
+        self.state = state
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address[:2])
+
+
+def start_receiver(port=0, **kwargs):
+    ''' start a `FakeReceiver` in a background thread
+
+        returns the server (`server.url`, `server.state`,
+        `server.shutdown`) '''
+    server = FakeReceiver(('127.0.0.1', port), FakeReceiverState(**kwargs))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Fake anam-receiver listening on {}".format(server.url))
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Local stand-in anam-receiver")
+    parser.add_argument('fixtures_dir')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--token', default=None)
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds added to every request")
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help="bytes per second (both ways)")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="ratio of requests answered with a 503")
+    args = parser.parse_args(argv)
+
+    server = FakeReceiver(('127.0.0.1', args.port), FakeReceiverState(
+        fixtures_dir=args.fixtures_dir, token=args.token,
+        latency=args.latency, bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate))
+    logger.info("Fake anam-receiver listening on {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Stats: {}".format(server.state.stats))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
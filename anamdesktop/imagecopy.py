@@ -0,0 +1,611 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import io
+import os
+import time
+import queue
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from anamdesktop import logger, SETTINGS
+from anamdesktop.samba import new_backend, copy_files
+from anamdesktop.storage import (
+    RemoteDirCache, StorageError, StorageUnavailable, normpath)
+from anamdesktop.journal import COPIED, FAILED
+from anamdesktop.imagetransform import ImageTransformer, is_available
+
+
+class CopyStats(object):
+    ''' thread-safe counters of a copy run (throughput) '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_on = time.monotonic()
+        self.nb_files = 0
+        self.nb_bytes = 0
+        self.nb_failures = 0
+        self.nb_skipped = 0
+        self.nb_deduped = 0  # duplicates not sent (skipped, server copies)
+        self.bytes_deduped = 0  # written size of those
+        self.transform = None  # `TransformStats` if images recompressed
+        self.mismatches = []  # copies failing verification
+
+    def add(self, nb_files=0, nb_bytes=0, nb_failures=0, nb_skipped=0,
+            nb_deduped=0, bytes_deduped=0):
+        with self.lock:
+            self.nb_files += nb_files
+            self.nb_bytes += nb_bytes
+            self.nb_failures += nb_failures
+            self.nb_skipped += nb_skipped
+            self.nb_deduped += nb_deduped
+            self.bytes_deduped += bytes_deduped
+
+    @property
+    def duration(self):
+        return max(time.monotonic() - self.started_on, 0.001)
+
+    @property
+    def files_per_sec(self):
+        return self.nb_files / self.duration
+
+    @property
+    def mb_per_sec(self):
+        return self.nb_bytes / self.duration / 1024 / 1024
+
+    def __str__(self):
+        return ("{f} fichiers ({mb:.1f} Mo) en {d:.0f}s: "
+                "{fps:.1f} fichiers/s, {mbps:.2f} Mo/s, {e} erreurs, "
+                "{s} inchangés, {m} non conformes, "
+                "{dd} doublons ({ddmb:.1f} Mo)"
+                .format(f=self.nb_files, mb=self.nb_bytes / 1024 / 1024,
+                        d=self.duration, fps=self.files_per_sec,
+                        mbps=self.mb_per_sec, e=self.nb_failures,
+                        s=self.nb_skipped, m=len(self.mismatches),
+                        dd=self.nb_deduped,
+                        ddmb=self.bytes_deduped / 1024 / 1024))
+
+
+class SessionPool(object):
+    ''' bounded pool of `size` storage backends (one connection each) '''
+
+    def __init__(self, size, **kwargs):
+        self.sessions = [new_backend(**kwargs) for _ in range(size)]
+        self.available = queue.Queue()
+        for session in self.sessions:
+            self.available.put(session)
+
+    def acquire(self):
+        return self.available.get()
+
+    def release(self, session):
+        self.available.put(session)
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+class CopyItem(object):
+    ''' a file going through the copy pipeline '''
+
+    def __init__(self, index, source, destination):
+        self.index = index  # of its task
+        self.source = source
+        self.destination = destination
+        self.size = None  # of source file
+        self.hash = None  # of source file (with check_hash)
+        self.data = None  # content to copy (bytes)
+        self.error = None
+        self.copy_of = None  # item with identical content (duplicate)
+        self.duplicates = []  # items with identical content
+
+    @property
+    def entry(self):
+        return self.source, self.destination
+
+
+STOP = None  # end of pipeline queue
+
+
+def get_checksum(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_size(source, sizes=None):
+    ''' size of `source` file from `sizes` ({path: size}) or disk '''
+    if sizes is not None and source in sizes:
+        return sizes[source]
+    return os.path.getsize(source)
+
+
+def find_duplicates(files, nb_workers=1, sizes=None):
+    ''' ({duplicate: original}, {entry: sha1}) of identical `files`
+
+        files is a list of (source_path, destination_path). original is
+        the first entry with the same content. only files sharing their
+        size with another are read and hashed (in parallel).
+        sizes ({source_path: size}) are read from disk if not in `sizes` '''
+    by_size = {}
+    for entry in files:
+        try:
+            by_size.setdefault(get_size(entry[0], sizes), []).append(entry)
+        except OSError:
+            continue
+    candidates = [entry for entries in by_size.values() if len(entries) > 1
+                  for entry in entries]
+
+    def _hash(entry):
+        try:
+            with open(entry[0], 'rb') as f:
+                return get_checksum(f.read())
+        except OSError as exp:
+            logger.exception(exp)
+            return None
+
+    sources = {}  # source_path: sha1 (same file for several destinations)
+    for entry in candidates:
+        sources.setdefault(entry[0], None)
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        sources.update(zip(sources.keys(), executor.map(
+            _hash, [(source, None) for source in sources.keys()])))
+
+    hashes = {}
+    originals = {}  # sha1: entry
+    duplicates = {}
+    for entry in candidates:
+        checksum = sources[entry[0]]
+        if checksum is None:
+            continue
+        hashes[entry] = checksum
+        if checksum in originals:
+            duplicates[entry] = originals[checksum]
+        else:
+            originals[checksum] = entry
+    return duplicates, hashes
+
+
+def verify_copies(copies, pool, nb_workers=1):
+    ''' destinations of `copies` which remote file does not match
+
+        `copies` is {destination: (size, sha1 or None)}.
+        each destination folder is listed once (in parallel, using
+        backends from `pool`) to compare sizes in bulk. files with a sha1
+        (sample) are also read back and their content compared. '''
+    folders = {}
+    for destination in copies.keys():
+        folder, _, name = normpath(destination).rpartition('/')
+        folders.setdefault(folder, []).append((destination, name))
+
+    def _verify_folder(folder):
+        backend = pool.acquire()
+        try:
+            remote = {entry.name: entry.size
+                      for entry in backend.list(folder) if not entry.is_dir}
+            mismatches = []
+            for destination, name in folders[folder]:
+                size, checksum = copies[destination]
+                if remote.get(name) != size:
+                    logger.error("Size mismatch for `{}`: {} (expected {})"
+                                 .format(destination, remote.get(name), size))
+                    mismatches.append(destination)
+                    continue
+                if checksum is None:
+                    continue
+                content = io.BytesIO()
+                backend.retrieve(destination, content)
+                if get_checksum(content.getvalue()) != checksum:
+                    logger.error("Content mismatch for `{}`"
+                                 .format(destination))
+                    mismatches.append(destination)
+            return mismatches
+        except StorageUnavailable:
+            raise
+        except StorageError as exp:
+            logger.exception(exp)
+            return [destination for destination, name in folders[folder]]
+        finally:
+            pool.release(backend)
+
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        return [destination
+                for mismatches in executor.map(_verify_folder, folders)
+                for destination in mismatches]
+
+
+def parallel_copy(tasks, nb_workers=None, progress=None, service_name=None,
+                  skip_unchanged=None, check_hash=None,
+                  journal=None, collect_id=None, recompress=None,
+                  queue_size=None, verify=None, verify_sample=None,
+                  dedup=None, sizes=None):
+    ''' copy files of all `tasks` to SMB share through a 3-stages pipeline
+
+        tasks is a list of (label, [(source_path, destination_path), ])
+
+        - a reader thread reads (prefetches) source files content.
+        - processing threads hash (with `check_hash`) and recompress
+          (with `recompress` and Pillow. see `ImageTransformer`) content.
+        - `nb_workers` writer threads (one SMB connection each) store
+          content onto the share. remote folders cache is shared.
+
+        stages are linked by queues of `queue_size` files so that USB and
+        network I/O overlap while memory use is capped.
+
+        `progress` is called with (nb_done, nb_tasks, label, stats)
+        once all files of a task are done.
+
+        with `skip_unchanged`, files already on the share with the same
+        size (and same hash with `check_hash`) are not copied again.
+        without `check_hash` nor `recompress`, source size is compared
+        before the file is even read (reader lists remote folders).
+
+        with a `journal` (`CopyJournal`), each copy of `collect_id` is
+        recorded and files already recorded as copied (same size and
+        hash) are skipped without reaching the share (resume).
+
+        with `verify`, written files are checked once all are copied
+        (see `verify_copies()`), reading back `verify_sample` (ratio) of
+        them. mismatches are in `stats.mismatches` (and journal).
+
+        with `dedup` (`copy` or `skip`), files of a task with identical
+        content (see `find_duplicates()`) are read and processed once.
+        once the original is on the share, duplicates are either copied
+        from it (server-side if the backend supports it, sending the
+        original's content again otherwise) or not written at all
+        (`skip`).
+
+        `sizes` ({source_path: size}, see `SourceIndex`) spares a
+        metadata lookup per source file.
+
+        raises StorageUnavailable if connection is definitely lost.
+        returns ([list, of, failures], stats) '''
+
+    nb_workers = int(nb_workers or SETTINGS.get('picserv_workers'))
+    queue_size = int(queue_size or SETTINGS.get('copy_queue_size'))
+    if skip_unchanged is None:
+        skip_unchanged = SETTINGS.get('copy_skip_unchanged')
+    if check_hash is None:
+        check_hash = SETTINGS.get('copy_check_hash')
+    if recompress is None:
+        recompress = SETTINGS.get('copy_recompress')
+    if verify is None:
+        verify = SETTINGS.get('copy_verify')
+    if verify_sample is None:
+        verify_sample = float(SETTINGS.get('copy_verify_sample'))
+    if dedup is None:
+        dedup = SETTINGS.get('copy_dedup')
+    if recompress and not is_available():
+        logger.warning("Pillow not available. Images won't be recompressed.")
+        recompress = False
+
+    copied = journal.get_copied(collect_id) if journal is not None else {}
+    # previously failed (or mismatching) remote files are not trusted
+    failed = set([destination for source, destination, status
+                  in journal.get_entries(collect_id, FAILED)]) \
+        if journal is not None else set()
+    transformer = ImageTransformer() if recompress else None
+    nb_processors = transformer.nb_workers if transformer is not None else 1
+
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    pool = SessionPool(nb_workers, service_name=service_name)
+    dir_cache = RemoteDirCache()
+    stats = CopyStats()
+    failures = []
+    lock = threading.Lock()
+    pending = [len(files) for label, files in tasks]
+    written = {}  # destination: item, (size, sha1) of written content
+    done = [0]
+    abort = threading.Event()
+
+    def _put(fifo, item):
+        # blocks while queue is full unless copy is aborted
+        while not abort.is_set():
+            try:
+                return fifo.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+
+    def _get(fifo):
+        while not abort.is_set():
+            try:
+                return fifo.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return STOP
+
+    def _task_done(index, nb_files=1):
+        with lock:
+            pending[index] -= nb_files
+            if pending[index] > 0:
+                return
+            done[0] += 1
+            nb_done = done[0]
+        if progress is not None:
+            progress(nb_done, len(tasks), tasks[index][0], stats)
+
+    def _record(item, status):
+        if journal is None:
+            return
+        if status == COPIED:
+            journal.record(collect_id, item.source, item.destination,
+                           status, item.size, item.hash)
+        else:
+            journal.record(collect_id, item.source, item.destination, status)
+
+    def _is_journaled(item):
+        if item.destination not in copied:
+            return False
+        size, file_hash = copied[item.destination]
+        return size == item.size and (not check_hash or
+                                      file_hash == item.hash)
+
+    def _resumed(item, fifo=None, reason="journal"):
+        logger.debug("Already copied ({}): `{}`"
+                     .format(reason, item.destination))
+        stats.add(nb_skipped=1)
+        _task_done(item.index)
+        # original is on share: duplicates can go down the pipeline
+        for duplicate in item.duplicates:
+            _put(fifo, duplicate)
+
+    def _failed(item):
+        with lock:
+            failures.append(item.entry)
+        stats.add(nb_failures=1)
+        _record(item, FAILED)
+        _task_done(item.index)
+        for duplicate in item.duplicates:
+            _failed(duplicate)
+
+    def _is_unchanged(item, remote_size, size):
+        if remote_size != size or item.destination in failed:
+            return False
+        return not check_hash or \
+            (copied.get(item.destination) or (None, None))[1] == item.hash
+
+    # unchanged files can be skipped from source size (before reading)
+    precheck = skip_unchanged and not check_hash and transformer is None
+    reader_session = []  # own backend of reader (lazy)
+
+    def _is_on_share(item):
+        if not reader_session:
+            reader_session.append(new_backend(service_name=service_name))
+        dir_cache.list_folder(reader_session[0],
+                              normpath(item.destination).rpartition('/')[0])
+        return _is_unchanged(
+            item, dir_cache.get_size(item.destination), item.size)
+
+    def _read():
+        # stage 1: USB read-ahead
+        try:
+            for index, (label, files) in enumerate(tasks):
+                if not files:
+                    _task_done(index, 0)
+                duplicates, hashes = find_duplicates(
+                    files, SETTINGS.get('usb_scan_workers'), sizes) \
+                    if dedup else ({}, {})
+                items = [CopyItem(index, source, destination)
+                         for source, destination in files]
+                originals = {item.entry: item for item in items}
+                for item in items:
+                    if item.entry in duplicates:
+                        # follows its original (read only once)
+                        item.copy_of = originals[duplicates[item.entry]]
+                        item.copy_of.duplicates.append(item)
+                        item.hash = hashes[item.entry]
+                for item in items:
+                    if abort.is_set():
+                        return
+                    if item.copy_of is not None:
+                        continue
+                    source = item.source
+                    try:
+                        item.size = get_size(source, sizes)
+                        if not check_hash and _is_journaled(item):
+                            _resumed(item, read_queue)
+                            continue
+                        if precheck and _is_on_share(item):
+                            _record(item, COPIED)
+                            _resumed(item, read_queue, "same size")
+                            continue
+                        with open(source, 'rb') as f:
+                            item.data = f.read()
+                    except OSError as exp:
+                        logger.exception(exp)
+                        item.error = exp
+                    _put(read_queue, item)
+        except BaseException:
+            # other stages would wait for items forever
+            abort.set()
+            raise
+        finally:
+            for _ in range(nb_processors):
+                _put(read_queue, STOP)
+            for session in reader_session:
+                session.close()
+
+    def _process():
+        # stage 2: hash and transform
+        try:
+            while True:
+                item = _get(read_queue)
+                if item is STOP:
+                    return
+                if item.copy_of is not None:
+                    # duplicate: nothing to read nor transform
+                    _put(write_queue, item)
+                    continue
+                if item.error is None and check_hash:
+                    item.hash = hashlib.sha1(item.data).hexdigest()
+                    if _is_journaled(item):
+                        _resumed(item, write_queue)
+                        continue
+                if item.error is None and transformer is not None:
+                    try:
+                        item.data = transformer.transform(item.data)
+                    except Exception as exp:
+                        logger.exception(exp)
+                _put(write_queue, item)
+        except BaseException:
+            abort.set()
+            raise
+
+    def _load(item):
+        # content to write for `item` (read and transformed)
+        with open(item.source, 'rb') as f:
+            data = f.read()
+        if transformer is not None:
+            try:
+                data = transformer.transform(data)
+            except Exception as exp:
+                logger.exception(exp)
+        return data
+
+    def _write_duplicate(session, item, data=None):
+        # identical content is on the share at `item.copy_of.destination`
+        # `data` is the original's written content (None if resumed)
+        item.size = item.copy_of.size
+        if _is_journaled(item):
+            return _resumed(item)
+        if dedup == 'skip':
+            logger.debug("Not writing duplicate `{}` of `{}`".format(
+                item.destination, item.copy_of.destination))
+            size = len(data) if data is not None \
+                else dir_cache.get_size(item.copy_of.destination)
+            stats.add(nb_deduped=1, bytes_deduped=size or item.size)
+            return _task_done(item.index)
+
+        try:
+            if skip_unchanged:
+                dir_cache.list_folder(
+                    session, normpath(item.destination).rpartition('/')[0])
+                size = dir_cache.get_size(item.copy_of.destination)
+                if size is not None and _is_unchanged(
+                        item, dir_cache.get_size(item.destination), size):
+                    stats.add(nb_skipped=1)
+                    _record(item, COPIED)
+                    return _task_done(item.index)
+
+            if session.server_side_copy:
+                size = session.copy(item.copy_of.destination,
+                                    item.destination)
+                stats.add(nb_deduped=1, bytes_deduped=size)
+            else:
+                # reading original back then storing it costs more than
+                # sending content again (re-read if original resumed)
+                if data is None:
+                    data = _load(item)
+                size = session.store(item.destination, io.BytesIO(data))
+                stats.add(nb_bytes=size)
+            dir_cache.add_file(item.destination, size)
+        except StorageUnavailable:
+            raise
+        except Exception as exp:
+            logger.exception(exp)
+            return _failed(item)
+
+        _record(item, COPIED)
+        stats.add(nb_files=1)
+        with lock:
+            written[item.destination] = item, (size, None)
+        _task_done(item.index)
+
+    def _write_item(session, item):
+        if item.copy_of is not None:
+            return _write_duplicate(session, item)
+        if item.error is not None:
+            return _failed(item)
+
+        def _unchanged(source, destination, remote_size):
+            return _is_unchanged(item, remote_size, len(item.data))
+
+        skipped = []
+        try:
+            success, item_failures = copy_files(
+                [item.entry], service_name=service_name,
+                backend=session, dir_cache=dir_cache,
+                unchanged=_unchanged if skip_unchanged else None,
+                skipped=skipped, sources={item.source: item.data})
+        except StorageUnavailable:
+            raise
+        except Exception as exp:
+            logger.exception(exp)
+            item_failures = [item.entry]
+
+        if item_failures:
+            return _failed(item)
+        _record(item, COPIED)
+        if skipped:
+            stats.add(nb_skipped=1)
+        else:
+            stats.add(nb_files=1, nb_bytes=len(item.data))
+            checksum = get_checksum(item.data) \
+                if verify and random.random() < verify_sample else None
+            with lock:
+                written[item.destination] = item, (len(item.data), checksum)
+        _task_done(item.index)
+        for duplicate in item.duplicates:
+            _write_duplicate(session, duplicate, item.data)
+        item.data = None
+
+    def _write():
+        # stage 3: SMB writers
+        session = pool.acquire()
+        try:
+            while True:
+                item = _get(write_queue)
+                if item is STOP:
+                    return
+                _write_item(session, item)
+        except BaseException:
+            # remaining items can't be written: stop all stages
+            abort.set()
+            raise
+        finally:
+            pool.release(session)
+
+    logger.info("Copying {} dossiers with {} writers ({} processors)"
+                .format(len(tasks), nb_workers, nb_processors))
+    try:
+        if transformer is not None:
+            transformer.start()
+            stats.transform = transformer.stats
+        with ThreadPoolExecutor(
+                max_workers=1 + nb_processors + nb_workers) as executor:
+            writers = [executor.submit(_write) for _ in range(nb_workers)]
+            readers = [executor.submit(_read)] + \
+                [executor.submit(_process) for _ in range(nb_processors)]
+            try:
+                for future in readers:
+                    future.result()
+                for _ in writers:
+                    _put(write_queue, STOP)
+                for future in writers:
+                    # re-raises StorageUnavailable from writers
+                    future.result()
+            except Exception:
+                # stop all stages before waiting for them
+                abort.set()
+                raise
+
+        if verify and written:
+            logger.info("Verifying {} copied files".format(len(written)))
+            for destination in verify_copies(
+                    {destination: expected for destination, (item, expected)
+                     in written.items()}, pool, nb_workers):
+                item = written[destination][0]
+                stats.mismatches.append(item.entry)
+                _record(item, FAILED)
+    finally:
+        pool.close()
+        if transformer is not None:
+            transformer.close()
+        logger.info("Copy stats: {}".format(stats))
+        logger.info("Remote folders cache saved {} SMB round trips"
+                    .format(dir_cache.saved))
+
+    return failures, stats
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' optional downscaling/recompression of JPEG attachments before copy
+
+    requires Pillow. without it, all files pass through untouched. '''
+
+import io
+import os
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+from anamdesktop import logger, SETTINGS
+
+
+def is_available():
+    return Image is not None
+
+
+def recompress(data, max_dimension, quality):
+    ''' downscaled, re-encoded copy of JPEG `data` (bytes)
+
+        run in a worker process.
+        returns (new bytes or None if passed-through, cpu time) '''
+    started = time.process_time()
+    output = io.BytesIO()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.format != 'JPEG':
+                return None, time.process_time() - started
+            # EXIF is not kept: apply phone's orientation to pixels
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension))
+            image.convert('RGB').save(output, 'JPEG', quality=quality,
+                                      optimize=True)
+    except (OSError, ValueError):
+        # unreadable or not an image: copy it as is
+        return None, time.process_time() - started
+
+    if output.tell() >= len(data):
+        return None, time.process_time() - started
+    return output.getvalue(), time.process_time() - started
+
+
+class TransformStats(object):
+    ''' thread-safe counters of recompressed/passed-through files '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.nb_processed = 0
+        self.nb_passed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0
+
+    def add(self, size_in, size_out=None, cpu_time=0):
+        with self.lock:
+            self.cpu_time += cpu_time
+            if size_out is None:
+                self.nb_passed += 1
+                return
+            self.nb_processed += 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def __str__(self):
+        return ("{p} images recompressées, {n} inchangées, "
+                "{s:.1f} Mo économisés, {c:.1f}s CPU"
+                .format(p=self.nb_processed, n=self.nb_passed,
+                        s=self.bytes_saved / 1024 / 1024, c=self.cpu_time))
+
+
+class ImageTransformer(object):
+    ''' recompresses images content in a process pool
+
+        images smaller than `min_size` bytes pass through untouched as do
+        non-JPEG files and those that would not get smaller.
+        process pool runs between `start()` and `close()` (or context). '''
+
+    def __init__(self, max_dimension=None, quality=None, min_size=None,
+                 nb_workers=None):
+        self.max_dimension = int(max_dimension or
+                                 SETTINGS.get('copy_max_dimension'))
+        self.quality = int(quality or SETTINGS.get('copy_jpeg_quality'))
+        self.min_size = int(min_size if min_size is not None
+                            else SETTINGS.get('copy_recompress_min_size'))
+        self.nb_workers = int(nb_workers or
+                              SETTINGS.get('copy_recompress_workers') or
+                              os.cpu_count() or 1)
+        self.stats = TransformStats()
+        self.executor = None
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.nb_workers)
+
+    def close(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown()
+        self.executor = None
+        logger.info("Image transform stats: {}".format(self.stats))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def transform(self, data):
+        ''' image content to copy in place of `data` (bytes)
+
+            blocks until processed. call from several threads to
+            keep all worker processes busy. '''
+        if len(data) < self.min_size:
+            self.stats.add(len(data))
+            return data
+        output, cpu_time = self.executor.submit(
+            recompress, data, self.max_dimension, self.quality).result()
+        if output is None:
+            self.stats.add(len(data), cpu_time=cpu_time)
+            return data
+        self.stats.add(len(data), len(output), cpu_time)
+        return output
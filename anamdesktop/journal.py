@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import sqlite3
+import datetime
+import threading
+
+from anamdesktop import logger, DATA_DIR
+
+JOURNAL_FPATH = os.path.join(DATA_DIR, 'copy-journal.sqlite')
+
+COPIED = 'copied'
+FAILED = 'failed'
+MISSING = 'missing'
+
+
+class CopyJournal(object):
+    ''' machine-readable record of image copies, per collect and destination
+
+        each successful store is recorded (with source size and optional
+        hash) so that an interrupted or partial copy resumes with only
+        the remaining and failed files.
+        connection is shared by copy workers (serialized by a lock). '''
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS copies (
+        collect_id TEXT NOT NULL,
+        destination TEXT NOT NULL,
+        source TEXT NOT NULL,
+        status TEXT NOT NULL,
+        size INTEGER,
+        hash TEXT,
+        updated_on TEXT NOT NULL,
+        PRIMARY KEY (collect_id, destination))'''
+
+    def __init__(self, fpath=JOURNAL_FPATH):
+        self.fpath = fpath
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(fpath)), exist_ok=True)
+        self.conn = sqlite3.connect(fpath, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def record(self, collect_id, source, destination, status,
+               size=None, file_hash=None):
+        ''' record (replace) outcome of a single file copy '''
+        self.record_many(collect_id,
+                         [(source, destination, status, size, file_hash)])
+
+    def record_many(self, collect_id, entries):
+        ''' record outcome of many files in one transaction
+
+            `entries` is a list of
+            (source, destination, status, size, hash) '''
+        now = datetime.datetime.now().isoformat()
+        rows = [(str(collect_id), destination, source, status, size,
+                 file_hash, now)
+                for source, destination, status, size, file_hash in entries]
+        if not rows:
+            return
+        try:
+            with self.lock, self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO copies (collect_id, destination, "
+                    "source, status, size, hash, updated_on) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        except sqlite3.Error as exp:
+            logger.error("Unable to record copies in journal")
+            logger.exception(exp)
+
+    def get_copied(self, collect_id):
+        ''' {destination: (size, hash)} of successfully copied files '''
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT destination, size, hash FROM copies "
+                "WHERE collect_id = ? AND status = ?",
+                (str(collect_id), COPIED)).fetchall()
+        return {destination: (size, file_hash)
+                for destination, size, file_hash in rows}
+
+    def get_entries(self, collect_id, status=None):
+        ''' list of (source, destination, status) for `collect_id` '''
+        query = "SELECT source, destination, status FROM copies " \
+                "WHERE collect_id = ?"
+        params = [str(collect_id)]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def get_summary(self, collect_id):
+        ''' {status: nb_files} for `collect_id` '''
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT status, COUNT(*) FROM copies WHERE collect_id = ? "
+                "GROUP BY status", (str(collect_id),)).fetchall()
+        return dict(rows)
+
+    def clear(self, collect_id):
+        ''' forget all copies of `collect_id` (forces a full re-copy) '''
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM copies WHERE collect_id = ?",
+                              (str(collect_id),))
+
+
+_journal = None
+
+
+def get_journal():
+    ''' shared `CopyJournal` instance '''
+    global _journal
+    if _journal is None:
+        _journal = CopyJournal()
+    return _journal
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import re
+import json
+from collections import Counter
+
+CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+NUMBER_TAIL = re.compile(r'[0-9.eE+-]*')
+
+
+class StreamReader(object):
+    ''' buffered reader over a JSON text file
+
+        decodes values one at a time so that only the current value
+        is held in memory, not the whole document. '''
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        ''' append next chunk to buffer, dropping already consumed part '''
+        chunk = self.fileobj.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        ''' next non-whitespace character (not consumed). empty on EOF '''
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        ''' consume `char` or raise ValueError '''
+        found = self.peek()
+        if found != char:
+            raise ValueError("Expected `{c}`, found `{f}`"
+                             .format(c=char, f=found))
+        self.pos += 1
+
+    def decode(self):
+        ''' decode and consume the next complete JSON value '''
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            else:
+                if self.eof or not self.is_truncated(value, end):
+                    self.pos = end
+                    return value
+            self.fill(size)
+            size *= 2
+
+    def is_truncated(self, value, end):
+        ''' whether decoded `value` might continue past the buffer
+
+            a number followed only by number characters up to the end
+            of buffer might be incomplete (`123.` of `123.5`) '''
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return NUMBER_TAIL.match(self.buf, end).end() == len(self.buf)
+
+    def iter_object(self):
+        ''' yields keys of the object at cursor
+
+            caller must consume the value (decode, iter_*) before next key '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode()
+            self.expect(':')
+            yield key
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            self.expect(',')
+
+    def iter_array(self):
+        ''' yields index of each item of the array at cursor
+
+            caller must consume the item (decode, iter_*) before next one '''
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+
+class LazyArray(object):
+    ''' placeholder for a JSON array left on disk
+
+        iterating re-reads items one by one from the file.
+        `counts` holds {key: Counter of values} of items' `count_by` keys
+        (see `load()`) '''
+
+    def __init__(self, fpath, path, length, counts=None):
+        self.fpath = fpath
+        self.path = tuple(path)
+        self.length = length
+        self.counts = counts or {}
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter_items(self.fpath, self.path)
+
+    def __repr__(self):
+        return "<LazyArray {p} ({n} items)>".format(
+            p="/".join(self.path), n=self.length)
+
+
+def open_json(fpath):
+    return open(fpath, 'r', encoding='utf-8')
+
+
+def iter_items(fpath, path):
+    ''' yields each item of the array at `path` (tuple of keys) in `fpath` '''
+
+    def _walk(reader, remaining):
+        if not remaining:
+            for _ in reader.iter_array():
+                yield reader.decode()
+            return
+
+        for key in reader.iter_object():
+            if key == remaining[0]:
+                yield from _walk(reader, remaining[1:])
+            else:
+                reader.decode()
+
+    with open_json(fpath) as f:
+        yield from _walk(StreamReader(f), tuple(path))
+
+
+def load(fpath, lazy=None, count_by=None):
+    ''' decode JSON file at `fpath`
+
+        the array at `lazy` path (tuple of keys) is not materialized
+        but replaced by a `LazyArray` reading it from disk on iteration.
+        values of `count_by` keys of its items are counted in the same
+        pass (see `LazyArray.counts`) '''
+
+    lazy = tuple(lazy or ())
+    count_by = tuple(count_by or ())
+
+    def _read(reader, path):
+        if lazy and path == lazy:
+            # only count items, dropping each once decoded
+            length = 0
+            counts = {key: Counter() for key in count_by}
+            for _ in reader.iter_array():
+                item = reader.decode()
+                length += 1
+                if isinstance(item, dict):
+                    for key in count_by:
+                        counts[key][item.get(key)] += 1
+            return LazyArray(fpath, lazy, length, counts)
+
+        if path != lazy[:len(path)] or reader.peek() != '{':
+            return reader.decode()
+
+        return {key: _read(reader, path + (key,))
+                for key in reader.iter_object()}
+
+    with open_json(fpath) as f:
+        return _read(StreamReader(f), ())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+
+from anamdesktop import logger
+from anamdesktop.utils import get_folder_name, VALID_ATTACHMENTS
+
+
+class ImageEntry(object):
+    ''' an attachment image to copy: from USB folder to share '''
+
+    def __init__(self, attachment_id, slug, folder, fname,
+                 perso_id, perso_type, destination):
+        self.attachment_id = attachment_id
+        self.slug = slug
+        self.folder = folder  # dossier folder on USB (from `hamed`)
+        self.fname = fname
+        self.perso_id = perso_id
+        self.perso_type = perso_type
+        self.destination = destination  # share-relative path
+
+    def get_source(self, source_dir):
+        return os.path.join(source_dir, self.folder, self.fname)
+
+
+class DossierEntry(object):
+    ''' a target (household) and its images '''
+
+    def __init__(self, ident, dos_id, name, folder):
+        self.ident = ident
+        self.dos_id = dos_id
+        self.name = name
+        self.folder = folder
+        self.images = []
+
+    @property
+    def label(self):
+        return "{n}: {d}".format(n=self.name, d=self.dos_id)
+
+
+class ImageManifest(object):
+    ''' all images of a collect, built in a single pass over targets
+
+        attachments are deduplicated (by ID then by source/destination)
+        and their perso_id/perso_type and destination resolved from the
+        dossiers `mappings` (as returned on import).
+        targets lacking required data are listed in `invalid` (idents). '''
+
+    def __init__(self, targets, mappings):
+        self.dossiers = []
+        self.invalid = []
+        for target in targets or []:
+            self.add_target(target, mappings or {})
+
+    def add_target(self, target, mappings):
+        ident = target.get("ident")
+        try:
+            mapping = mappings.get(ident)
+            dos_id = mapping.get('dossier')
+            indigent_perso_id = mapping.get('indigent')
+            first_name = target.get("enquete/prenoms")
+            last_name = target.get("enquete/nom")
+            name = "{last} {firsts}".format(
+                last=last_name.upper(),
+                firsts=first_name.title())
+            folder = get_folder_name(ident, last_name, first_name)
+            assert dos_id
+            assert indigent_perso_id
+            assert name
+            assert folder
+        except Exception as exp:
+            # should NEVER happen
+            logger.error("Missing indigent data in dataset for {}"
+                         .format(ident))
+            logger.exception(exp)
+            self.invalid.append(ident)
+            return
+
+        dossier = DossierEntry(ident, dos_id, name, folder)
+        seen_ids = set()
+        seen_paths = set()
+        for attachment in target.get("_attachments") or []:
+            slug = attachment['labels']['slug']
+
+            # skip other attachments
+            if slug not in VALID_ATTACHMENTS:
+                continue
+
+            # skip if already copied (_hamed as duplicates)
+            if attachment['id'] in seen_ids:
+                continue
+            seen_ids.add(attachment['id'])
+
+            # find its perso_id
+            fname = attachment['export_fname']
+            if 'epouse' in fname or 'enfant' in fname:
+                perso_id = mapping.get(fname.split("_", 2)[1])
+                perso_type = 'conjoint' if 'epouse' in fname else 'enfant'
+            else:
+                perso_id = indigent_perso_id
+                perso_type = 'assure'
+
+            # build destination file name and path
+            nfname = "{pid}_{ptype}_{dtype}.jpg".format(
+                pid=perso_id, dtype=slug, ptype=perso_type)
+            destination = "/".join([dos_id[-4:], dos_id, nfname])
+
+            # make sure we're not adding duplicates
+            if (fname, destination) in seen_paths:
+                continue
+            seen_paths.add((fname, destination))
+
+            dossier.images.append(ImageEntry(
+                attachment['id'], slug, folder, fname,
+                perso_id, perso_type, destination))
+        self.dossiers.append(dossier)
+
+    @property
+    def nb_dossiers(self):
+        return len(self.dossiers)
+
+    @property
+    def nb_images(self):
+        return sum([len(dossier.images) for dossier in self.dossiers])
+
+    def iter_images(self):
+        ''' yields (dossier, image) for all images '''
+        for dossier in self.dossiers:
+            for image in dossier.images:
+                yield dossier, image
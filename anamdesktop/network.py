@@ -2,12 +2,96 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import os
+import re
+import gzip
+import json
+import time
+import uuid
+import random
+import shutil
 import socket
+import tempfile
 import urllib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from anamdesktop import SETTINGS, logger
+from anamdesktop import jsonstream
+
+
+class ReceiverClient(object):
+    ''' pooled, keep-alive HTTP client for an `anam-receiver` instance
+
+        holds a single `requests.Session` which connections are reused
+        across calls (and threads) instead of opening a new TCP connection
+        for every request. '''
+
+    def __init__(self, server_url, pool_size=None,
+                 connect_timeout=None, read_timeout=None):
+        self.server_url = server_url
+        self.pool_size = int(pool_size or SETTINGS.get('store_pool_size'))
+        self.timeout = (
+            float(connect_timeout or SETTINGS.get('store_connect_timeout')),
+            float(read_timeout or SETTINGS.get('store_read_timeout')))
+        self.lock = threading.Lock()
+        self.session = self.create_session()
+
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.pool_size,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'Connection': "keep-alive",
+                                'Accept-Encoding': "gzip, deflate"})
+        return session
+
+    def get_url(self, path):
+        return ''.join((self.server_url, '/api', path))
+
+    def request(self, method, path, token=None, **kwargs):
+        ''' performs `method` request on `path` using the pooled session
+
+            returns the `requests.Response` '''
+        kwargs.setdefault('timeout', self.timeout)
+        headers = get_auth_headers(token)
+        headers.update(kwargs.pop('headers', {}))
+        with self.lock:
+            session = self.session
+        return session.request(method, self.get_url(path),
+                               headers=headers, **kwargs)
+
+    def close(self):
+        ''' close all pooled connections '''
+        with self.lock:
+            self.session.close()
+            self.session = self.create_session()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(server_url=None):
+    ''' shared `ReceiverClient` for `server_url` (defaults to settings) '''
+    server_url = server_url or SETTINGS.get('store_url', '')
+    with _clients_lock:
+        if server_url not in _clients:
+            _clients[server_url] = ReceiverClient(server_url)
+        return _clients[server_url]
+
+
+def close_clients():
+    ''' close all pooled connections of all shared clients '''
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
 
 
 def get_auth_headers(token=None):
@@ -16,41 +100,267 @@ def get_auth_headers(token=None):
         token or SETTINGS.get('store_token'))}
 
 
-def do_get(path, or_none=False, server_url=None, server_token=None):
+class RetryPolicy(object):
+    ''' exponential backoff (with full jitter) for failed requests
+
+        at most `max_attempts` per request. retries are also limited
+        app-wide by a budget of `budget` retries per minute so that an
+        outage does not turn into a retry storm. '''
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    BUDGET_WINDOW = 60
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None,
+                 budget=None):
+        self.max_attempts = int(
+            max_attempts or SETTINGS.get('retry_max_attempts'))
+        self.base_delay = float(
+            base_delay or SETTINGS.get('retry_base_delay'))
+        self.max_delay = float(max_delay or SETTINGS.get('retry_max_delay'))
+        self.budget = int(budget or SETTINGS.get('retry_budget'))
+        self.lock = threading.Lock()
+        self.retried_at = []
+        # endpoint: {'calls', 'retries', 'failures', 'duration'}
+        self.stats = {}
+
+    def get_delay(self, attempt):
+        ''' seconds to wait before retrying after `attempt` (1-based) '''
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def consume_budget(self):
+        ''' whether a retry is allowed by the budget (and counts it) '''
+        with self.lock:
+            now = time.monotonic()
+            self.retried_at = [ts for ts in self.retried_at
+                               if now - ts < self.BUDGET_WINDOW]
+            if len(self.retried_at) >= self.budget:
+                return False
+            self.retried_at.append(now)
+            return True
+
+    def record(self, endpoint, retries, failed, duration):
+        with self.lock:
+            stats = self.stats.setdefault(
+                endpoint,
+                {'calls': 0, 'retries': 0, 'failures': 0, 'duration': 0})
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['failures'] += int(failed)
+            stats['duration'] += duration
+        if retries or failed:
+            logger.info("{e}: {r} retries, {s}, {d:.2f}s. total for endpoint: "
+                        "{c} calls, {tr} retries, {tf} failures"
+                        .format(e=endpoint, r=retries,
+                                s="failed" if failed else "succeeded",
+                                d=duration, c=stats['calls'],
+                                tr=stats['retries'], tf=stats['failures']))
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+# whole path segments which are IDs: numbers, hex (and UUID) upload IDs
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-fA-F-]{8,})(?=/|$)')
+
+
+def get_endpoint(method, path):
+    ''' `path` with IDs replaced, to group stats per endpoint '''
+    return "{m} {p}".format(
+        m=method, p=ID_SEGMENT.sub('/{id}', path.split('?')[0]))
+
+
+def send_request(client, method, path, token=None, policy=None, **kwargs):
+    ''' `client.request()` retried according to `policy`
+
+        POST requests carry an `Idempotency-Key` header (same for
+        all attempts) so that the server can safely ignore duplicates.
+
+        returns the `requests.Response` (possibly an error status) '''
+
+    policy = policy or RETRY_POLICY
+    endpoint = get_endpoint(method, path)
+
+    if method.upper() == 'POST':
+        kwargs['headers'] = dict(kwargs.get('headers', {}))
+        kwargs['headers'].setdefault('Idempotency-Key', uuid.uuid4().hex)
+
+    started_on = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        error = None
+        try:
+            req = client.request(method, path, token=token, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as exp:
+            error = exp
+        else:
+            if req.status_code not in policy.RETRY_STATUSES:
+                policy.record(endpoint, attempt - 1, False,
+                              time.monotonic() - started_on)
+                return req
+
+        can_retry = attempt < policy.max_attempts and policy.consume_budget()
+        if not can_retry:
+            policy.record(endpoint, attempt - 1, True,
+                          time.monotonic() - started_on)
+            if error is None:
+                return req
+            # open the circuit so that next calls fail fast
+            BREAKER.record_failure(*get_url_address(client.server_url))
+            raise error
+
+        if error is None:
+            req.close()
+        delay = policy.get_delay(attempt)
+        logger.debug("{e}: attempt {a} failed ({r}). retrying in {d:.2f}s"
+                     .format(e=endpoint, a=attempt, d=delay,
+                             r=error or req.status_code))
+        time.sleep(delay)
+
+
+def do_get(path, or_none=False, server_url=None, server_token=None,
+           meta=None):
     ''' performs GET request on API.
 
         see. `do_request()` '''
     return do_request(path=path, method='GET',
                       or_none=or_none,
-                      server_url=server_url, server_token=server_token)
+                      server_url=server_url, server_token=server_token,
+                      meta=meta)
 
 
 def do_post(path, payload=None, or_none=False,
             server_url=None, server_token=None):
-    ''' performs POST request with `payload` on API.
+    ''' performs POST request with `payload` on API (no body if None).
 
         see. `do_request()` '''
-    return do_request(path, 'POST', {'json': payload},
+    return do_request(path, 'POST',
+                      encode_payload(payload) if payload is not None else {},
                       or_none=or_none,
                       server_url=server_url, server_token=server_token)
 
 
+def do_bulk_post(paths, payload=None, max_workers=None,
+                 server_url=None, server_token=None):
+    ''' performs POST requests on all `paths` concurrently
+
+        at most `max_workers` (defaults to pool size) requests are
+        in-flight at once, all sharing the pooled session.
+
+        returns a {path: success} dict '''
+
+    max_workers = max_workers or get_client(server_url).pool_size
+
+    def _post(path):
+        return do_post(path, payload=payload, or_none=True,
+                       server_url=server_url,
+                       server_token=server_token) is not None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(_post, paths)))
+
+
+class FileBody(object):
+    ''' request body streamed from a file in chunks
+
+        re-iterable (file is re-opened) so requests can be retried.
+        `progress` is called with (sent, total) bytes after each chunk '''
+
+    def __init__(self, fpath, progress=None, chunk_size=None):
+        self.fpath = fpath
+        self.progress = progress
+        self.chunk_size = chunk_size or jsonstream.CHUNK_SIZE
+        self.length = os.path.getsize(fpath)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        sent = 0
+        with open(self.fpath, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                yield chunk
+                sent += len(chunk)
+                if self.progress is not None:
+                    self.progress(sent, self.length)
+
+
+def do_upload_file(path, fpath, progress=None, or_none=False,
+                   server_url=None, server_token=None):
+    ''' performs POST request on API with content of JSON file `fpath`
+
+        file is streamed from disk in chunks (never loaded in memory).
+        if compression is enabled (see `encode_payload()`), it is first
+        gzip-compressed into a temporary file, in chunks too.
+
+        see. `do_request()` '''
+
+    level = int(SETTINGS.get('store_gzip_level'))
+    min_size = int(SETTINGS.get('store_gzip_min_size'))
+    headers = {'Content-Type': "application/json"}
+
+    compressed_fpath = None
+    if level and os.path.getsize(fpath) >= min_size:
+        fd, compressed_fpath = tempfile.mkstemp(suffix=".json.gz")
+        with open(fpath, 'rb') as f_in, os.fdopen(fd, 'wb') as raw, \
+                gzip.GzipFile(fileobj=raw, mode='wb',
+                              compresslevel=level) as f_out:
+            shutil.copyfileobj(f_in, f_out, jsonstream.CHUNK_SIZE)
+        logger.debug("Compressed {} from {} to {} bytes".format(
+            fpath, os.path.getsize(fpath), os.path.getsize(compressed_fpath)))
+        headers.update({'Content-Encoding': "gzip"})
+
+    try:
+        return do_request(
+            path, 'POST',
+            {'data': FileBody(compressed_fpath or fpath, progress=progress),
+             'headers': headers},
+            or_none=or_none, server_url=server_url, server_token=server_token)
+    finally:
+        if compressed_fpath is not None:
+            os.remove(compressed_fpath)
+
+
+def encode_payload(payload, level=None, min_size=None):
+    ''' `requests` kwargs to send `payload` as a JSON body
+
+        body is gzip-compressed (with `Content-Encoding` header)
+        at `level` if larger than `min_size` bytes. level 0 disables. '''
+
+    level = int(SETTINGS.get('store_gzip_level') if level is None else level)
+    min_size = int(SETTINGS.get('store_gzip_min_size')
+                   if min_size is None else min_size)
+
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': "application/json"}
+
+    if level and len(body) >= min_size:
+        compressed = gzip.compress(body, compresslevel=level)
+        logger.debug("Compressed payload from {} to {} bytes"
+                     .format(len(body), len(compressed)))
+        body = compressed
+        headers.update({'Content-Encoding': "gzip"})
+
+    return {'data': body, 'headers': headers}
+
+
 def do_request(path, method, kwargs={}, or_none=False,
-               server_url=None, server_token=None):
+               server_url=None, server_token=None, meta=None):
     ''' performs a GET or POST on `path`
 
         URL is computed from `server_url`, /api and `path`
         Authorization header sent with `server_token`
+        `meta` (dict) if passed, is updated with the response's
+        `status_code`.
 
         Excepts `anam-receiver` formatted JSON response.
         Raises on non-success status response.
 
         returns response as JSON '''
 
-    server_url = server_url or SETTINGS.get('store_url', '')
-    server_token = server_token or SETTINGS.get('store_token')
-
-    url = ''.join((server_url, '/api', path))
+    client = get_client(server_url)
+    url = client.get_url(path)
 
     if not test_url_socket(url):
         logger.info("{} requests to {} failed. No socket.".format(method, url))
@@ -61,8 +371,9 @@ def do_request(path, method, kwargs={}, or_none=False,
 
     req = None
     try:
-        req = getattr(requests, method.lower())(
-            url, headers=get_auth_headers(server_token), timeout=30, **kwargs)
+        req = send_request(client, method, path, token=server_token, **kwargs)
+        if meta is not None:
+            meta.update({'status_code': req.status_code})
         assert req.status_code in (200, 201)
         resp = req.json()
         assert resp['status'] == 'success'
@@ -78,28 +389,174 @@ def do_request(path, method, kwargs={}, or_none=False,
         raise
 
 
+def do_download(path, fpath, lazy=None, headers=None, meta=None,
+                or_none=False, server_url=None, server_token=None,
+                count_by=None):
+    ''' performs a streamed GET request on `path`
+
+        response body is written to `fpath` in chunks instead of
+        being held in memory.
+        `headers` can hold conditional headers (If-None-Match, etc):
+        on a 304 response, existing `fpath` is kept and used.
+        `meta` (dict) if passed, is updated with the response's
+        `status_code`, `etag` and `last_modified`.
+
+        returns response as JSON (see `do_request()`) with the array
+        at `lazy` path left on disk (see `jsonstream.load()` for
+        `lazy` and `count_by`) '''
+
+    client = get_client(server_url)
+    url = client.get_url(path)
+
+    if not test_url_socket(url):
+        logger.info("GET requests to {} failed. No socket.".format(url))
+        if or_none:
+            return None
+        else:
+            raise IOError("Unable to connect to {}. Network Error".format(url))
+
+    req = None
+    try:
+        req = send_request(client, 'GET', path, token=server_token,
+                           headers=headers or {}, stream=True)
+        assert req.status_code in (200, 304)
+        if meta is not None:
+            meta.update({'status_code': req.status_code,
+                         'etag': req.headers.get('ETag'),
+                         'last_modified': req.headers.get('Last-Modified')})
+        if req.status_code == 200:
+            # write to a temp file so `fpath` is never left incomplete
+            part_fpath = "{}.part".format(fpath)
+            with open(part_fpath, 'wb') as f:
+                for chunk in req.iter_content(
+                        chunk_size=jsonstream.CHUNK_SIZE):
+                    f.write(chunk)
+            os.replace(part_fpath, fpath)
+        resp = jsonstream.load(fpath, lazy=lazy, count_by=count_by)
+        assert resp['status'] == 'success'
+        return resp
+    except Exception as exp:
+        if req is not None:
+            logger.error("{} {}".format(req.status_code, url))
+        logger.exception(exp)
+
+        # silented error
+        if or_none:
+            return None
+        raise
+    finally:
+        if req is not None:
+            req.close()
+
+
+class CircuitBreaker(object):
+    ''' caches reachability of `address`:`port` services
+
+        - closed: service is reachable. cached for `ttl` seconds.
+        - open: service is unreachable. calls fail fast (no probe)
+          for `reset_timeout` seconds.
+        - half-open: `reset_timeout` elapsed. a single caller probes
+          the service while others keep failing fast. '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, ttl=None, reset_timeout=None, probe_timeout=2):
+        self.ttl = float(ttl or SETTINGS.get('breaker_ttl'))
+        self.reset_timeout = float(
+            reset_timeout or SETTINGS.get('breaker_reset_timeout'))
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        # (address, port): (state, timestamp of last change)
+        self.states = {}
+
+    def get_state(self, address, port):
+        with self.lock:
+            return self.states.get((address, port), (None, 0))[0]
+
+    def set_state(self, address, port, state):
+        with self.lock:
+            self.states[(address, port)] = (state, time.monotonic())
+
+    def record_success(self, address, port):
+        self.set_state(address, port, self.CLOSED)
+
+    def record_failure(self, address, port):
+        if self.get_state(address, port) != self.OPEN:
+            logger.info("Circuit opened for {}:{}".format(address, port))
+        self.set_state(address, port, self.OPEN)
+
+    def reset(self):
+        ''' forget all cached states (forces new probes) '''
+        with self.lock:
+            self.states.clear()
+
+    def probe(self, address, port):
+        ''' actual socket connection test. socket is always closed '''
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.probe_timeout)
+                return sock.connect_ex((address, port)) == 0
+        except (OSError, TypeError):
+            return False
+
+    def is_reachable(self, address, port):
+        key = (address, port)
+        with self.lock:
+            state, since = self.states.get(key, (None, 0))
+            elapsed = time.monotonic() - since
+
+            if state == self.CLOSED and elapsed < self.ttl:
+                return True
+
+            if state == self.HALF_OPEN and elapsed < self.probe_timeout:
+                # another thread is probing
+                return False
+
+            if state == self.OPEN:
+                if elapsed < self.reset_timeout:
+                    return False
+                self.states[key] = (self.HALF_OPEN, time.monotonic())
+
+        if self.probe(address, port):
+            self.record_success(address, port)
+            return True
+
+        self.record_failure(address, port)
+        return False
+
+
+BREAKER = CircuitBreaker()
+
+
 def test_socket(address, port):
     ''' tests whether a service is listening at `address`:`port`
 
-        timeouts after 2 seconds '''
+        uses the shared circuit breaker: cached when reachable,
+        fails fast when recently unreachable.
+        probe timeouts after 2 seconds '''
+
+    return BREAKER.is_reachable(address, port)
+
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(2)
-    result = sock.connect_ex((address, port))
-    return result == 0
+def get_url_address(url=None):
+    ''' (hostname, port) tuple from a URL '''
+    u = urllib.parse.urlparse(url or SETTINGS.get('store_url'))
+    return u.hostname, u.port or (443 if u.scheme == 'https' else 80)
 
 
 def test_url_socket(url=None):
     ''' shortcut to test if socket is opened from a URL '''
     try:
-        u = urllib.parse.urlparse(url or SETTINGS.get('store_url'))
+        address, port = get_url_address(url)
     except Exception as exp:
         logger.error("Unable to parse URL `{}`".format(url))
         logger.exception(exp)
         return False
 
     # check if address and port are reachable
-    return test_socket(u.hostname, u.port or 80)
+    return test_socket(address, port)
 
 
 def test_webservice(url=None, token=None):
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+import json
+import hashlib
+
+from anamdesktop import logger, SETTINGS, DATA_DIR
+from anamdesktop import jsonstream
+from anamdesktop.network import do_get, do_post
+
+UPLOADS_DIR = os.path.join(DATA_DIR, 'uploads')
+
+
+def get_checksum(data):
+    ''' sha256 hexdigest of `data` (bytes) '''
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_part_checksum(targets):
+    ''' checksum of a part's targets as canonical JSON '''
+    return get_checksum(json.dumps(targets, sort_keys=True).encode('utf-8'))
+
+
+def get_file_checksum(fpath):
+    ''' sha256 hexdigest of file at `fpath`, read in chunks '''
+    checksum = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(jsonstream.CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+class ChunkedUpload(object):
+    ''' resumable upload of a JSON export, `chunk_size` targets per part
+
+        protocol (anam-receiver):
+            - POST /upload/chunked/ with meta (all but targets) and
+              nb_parts. returns an `upload_id`.
+            - POST /upload/chunked/{upload_id}/parts/{n} with targets
+              and checksum of part #n.
+            - POST /upload/chunked/{upload_id}/complete
+
+        acknowledged parts are recorded in a local state file so that
+        an interrupted upload resumes from where it stopped. if the
+        server does not know the upload anymore (restarted, expired),
+        a new upload is started. '''
+
+    def __init__(self, fpath, chunk_size=None, progress=None):
+        self.fpath = fpath
+        self.chunk_size = int(chunk_size or SETTINGS.get('upload_chunk_size'))
+        self.progress = progress
+        self.state = None
+
+    @property
+    def state_fpath(self):
+        fid = hashlib.sha1(os.path.abspath(self.fpath).encode()).hexdigest()
+        return os.path.join(UPLOADS_DIR, "{}.json".format(fid))
+
+    def read_state(self, file_checksum):
+        ''' previous state for this file if still valid (same content) '''
+        try:
+            with open(self.state_fpath, 'r') as f:
+                state = json.load(f)
+        except Exception:
+            return None
+
+        if state.get('file_checksum') != file_checksum \
+                or state.get('chunk_size') != self.chunk_size \
+                or state.get('server_url') != SETTINGS.get('store_url'):
+            return None
+        return state
+
+    def save_state(self):
+        os.makedirs(UPLOADS_DIR, exist_ok=True)
+        with open(self.state_fpath, 'w') as f:
+            json.dump(self.state, f)
+
+    def remove_state(self):
+        try:
+            os.remove(self.state_fpath)
+        except OSError:
+            pass
+
+    def iter_parts(self):
+        ''' yields (part number, list of targets) from file '''
+        part = []
+        number = 0
+        for target in jsonstream.iter_items(self.fpath, ('targets',)):
+            part.append(target)
+            if len(part) == self.chunk_size:
+                yield number, part
+                number += 1
+                part = []
+        if part:
+            yield number, part
+
+    def start(self):
+        ''' resume from local state or initiate upload on server '''
+        file_checksum = get_file_checksum(self.fpath)
+        self.state = self.read_state(file_checksum)
+        if self.state is not None:
+            logger.info("Resuming upload {} ({}/{} parts acknowledged)"
+                        .format(self.state['upload_id'],
+                                len(self.state['acked']),
+                                self.state['nb_parts']))
+            return
+
+        dataset = jsonstream.load(self.fpath, lazy=('targets',))
+        nb_targets = len(dataset.pop('targets'))
+        nb_parts = -(-nb_targets // self.chunk_size)
+        resp = do_post('/upload/chunked/', payload={
+            'meta': dataset,
+            'nb_targets': nb_targets,
+            'nb_parts': nb_parts,
+            'checksum': file_checksum})
+        self.state = {
+            'upload_id': resp['upload_id'],
+            'server_url': SETTINGS.get('store_url'),
+            'file_checksum': file_checksum,
+            'chunk_size': self.chunk_size,
+            'nb_parts': nb_parts,
+            'acked': [],
+        }
+        self.save_state()
+        logger.info("Started chunked upload {} ({} parts)"
+                    .format(self.state['upload_id'], nb_parts))
+
+    def sync_acked(self):
+        ''' replace acknowledged parts with those received by server
+
+            local acks are kept only if the server can't be reached.
+            returns False if the server does not know the upload '''
+        meta = {}
+        resp = do_get('/upload/chunked/{}'.format(self.state['upload_id']),
+                      or_none=True, meta=meta)
+        if resp is None:
+            return meta.get('status_code') not in (404, 410)
+        received = sorted(set(resp.get('received', [])))
+        lost = set(self.state['acked']) - set(received)
+        if lost:
+            logger.warning("Upload {}: {} acknowledged parts lost by server"
+                           .format(self.state['upload_id'], len(lost)))
+        self.state['acked'] = received
+        self.save_state()
+        return True
+
+    def run(self):
+        ''' uploads all remaining parts then completes upload '''
+        self.start()
+        if not self.sync_acked():
+            logger.warning("Upload {} unknown to server. Starting over"
+                           .format(self.state['upload_id']))
+            self.remove_state()
+            self.start()
+        upload_id = self.state['upload_id']
+        acked = set(self.state['acked'])
+
+        for number, targets in self.iter_parts():
+            if number in acked:
+                continue
+            do_post('/upload/chunked/{id}/parts/{n}'.format(
+                id=upload_id, n=number), payload={
+                'part': number,
+                'checksum': get_part_checksum(targets),
+                'targets': targets})
+            acked.add(number)
+            self.state['acked'] = sorted(acked)
+            self.save_state()
+            if self.progress is not None:
+                self.progress(len(acked), self.state['nb_parts'])
+
+        do_post('/upload/chunked/{}/complete'.format(upload_id))
+        self.remove_state()
+        logger.info("Completed chunked upload {}".format(upload_id))
+        return True
@@ -2,21 +2,28 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+import io
 import os
 import uuid
+import socket
+import threading
 
 from path import Path as p
+from smb.base import SMBTimeout, NotConnectedError
 from smb.SMBConnection import SMBConnection
 from smb.smb_structs import OperationFailure
 
 from anamdesktop import logger, SETTINGS
-from anamdesktop.network import test_socket
+from anamdesktop.network import test_socket, BREAKER
+from anamdesktop.storage import (
+    StorageBackend, LocalBackend, RemoteEntry, StorageError,
+    StorageUnavailable, normpath)
 
 SAMBA_PORT = 445
 
-
-class FailedToCreateTree(Exception):
-    pass
+# session is lost (`socket.error` is any OSError: local I/O errors too)
+CONNECTION_ERRORS = (SMBTimeout, NotConnectedError, ConnectionError,
+                     socket.timeout, socket.gaierror, socket.herror)
 
 
 def smb_connect(address=None, username=None, password=None, server_name=None):
@@ -33,58 +40,263 @@ def smb_connect(address=None, username=None, password=None, server_name=None):
     return conn
 
 
-def create_folder(path, service_name=None, conn=None):
-    ''' create a folder at `path` on the SMB share `service_name` '''
+class SMBSession(StorageBackend):
+    ''' an authenticated SMBConnection kept alive across operations
+
+        operations are run through `run()` which serializes access
+        to the connection and reconnects (once) on `SMBTimeout`. '''
+
+    def __init__(self, address=None, username=None, password=None,
+                 server_name=None, service_name=None):
+        super().__init__()
+        self.address = address or SETTINGS.get('picserv_ip')
+        self.username = username or SETTINGS.get('picserv_username')
+        self.password = password or SETTINGS.get('picserv_password')
+        self.server_name = server_name or SETTINGS.get('picserv_name')
+        self.service_name = service_name or SETTINGS.get('picserv_share')
+        self.lock = threading.RLock()
+        self.conn = None
+
+    @property
+    def key(self):
+        return (self.address, self.username, self.password,
+                self.server_name, self.service_name)
+
+    def is_reachable(self):
+        # test whether server is reachable and has a samba service
+        if not test_socket(self.address, SAMBA_PORT):
+            return False
+        try:
+            self.get_connection()
+        except OSError:
+            # network-level failure: let other callers fail fast
+            BREAKER.record_failure(self.address, SAMBA_PORT)
+            return False
+        except Exception:
+            return False
+        return True
+
+    def connect(self):
+        with self.lock:
+            self.close()
+            logger.debug("Opening SMB session to {}".format(self.address))
+            self.conn = smb_connect(address=self.address,
+                                    username=self.username,
+                                    password=self.password,
+                                    server_name=self.server_name)
+            return self.conn
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except Exception:
+                    pass
+                self.conn = None
+
+    def get_connection(self):
+        with self.lock:
+            return self.conn or self.connect()
+
+    def _connection(self, fresh=False):
+        # live (or `fresh`) connection. StorageUnavailable if can't connect
+        try:
+            return self.connect() if fresh else self.get_connection()
+        except (OSError, AssertionError, SMBTimeout,
+                NotConnectedError) as exp:
+            self.close()
+            raise StorageUnavailable(
+                "Unable to connect to SMB server {}".format(self.address)) \
+                from exp
+
+    def run(self, func):
+        ''' calls `func(conn)` with the live connection
+
+            reconnects and calls again once on connection errors
+            (`CONNECTION_ERRORS`). pysmb failures are raised as
+            `StorageError` or `StorageUnavailable` (also if unable to
+            reconnect). other errors (local I/O) are raised as is '''
+        with self.lock:
+            try:
+                try:
+                    return func(self._connection())
+                except CONNECTION_ERRORS as exp:
+                    logger.info("SMB session to {} lost ({}). Reconnecting"
+                                .format(self.address,
+                                        exp.__class__.__name__))
+                    return func(self._connection(fresh=True))
+            except OperationFailure as exp:
+                raise StorageError(str(exp)) from exp
+            except CONNECTION_ERRORS as exp:
+                self.close()
+                raise StorageUnavailable(
+                    "SMB session to {} lost".format(self.address)) from exp
+
+    def mkdir(self, path):
+        self.run(lambda conn: conn.createDirectory(self.service_name, path))
+
+    def stat(self, path):
+        attrs = self.run(
+            lambda conn: conn.getAttributes(self.service_name, path))
+        return RemoteEntry(attrs.filename, attrs.isDirectory,
+                           attrs.file_size)
+
+    def list(self, path):
+        entries = self.run(lambda conn: conn.listPath(
+            self.service_name, normpath(path) or '/'))
+        return [RemoteEntry(entry.filename, entry.isDirectory,
+                            entry.file_size)
+                for entry in entries if entry.filename not in ('.', '..')]
+
+    def store(self, path, fileobj):
+        position = fileobj.tell()
+
+        def _store(conn):
+            # rewind if retried after a reconnection
+            fileobj.seek(position)
+            return conn.storeFile(self.service_name, path, fileobj)
+        return self.run(_store)
+
+    def retrieve(self, path, fileobj):
+        position = fileobj.tell()
+
+        def _retrieve(conn):
+            fileobj.seek(position)
+            fileobj.truncate()
+            return conn.retrieveFile(self.service_name, path, fileobj)[1]
+        return self.run(_retrieve)
+
+    def delete(self, path, folder=False):
+        if folder:
+            self.run(lambda conn: conn.deleteDirectory(
+                self.service_name, path))
+        else:
+            self.run(lambda conn: conn.deleteFiles(self.service_name, path))
+
+
+def new_backend(address=None, username=None, password=None,
+                server_name=None, service_name=None):
+    ''' storage backend for images as configured (`picserv_backend`)
 
-    conn = conn or smb_connect()
-    conn.createDirectory(
-        service_name=service_name or SETTINGS.get('picserv_share'), path=path)
+        `local` uses a `picserv_local_root` folder (for tests and
+        benchmarks), with share as subfolder. `smb` by default. '''
+    if SETTINGS.get('picserv_backend') == 'local':
+        return LocalBackend(
+            root=os.path.join(SETTINGS.get('picserv_local_root'),
+                              service_name or SETTINGS.get('picserv_share')),
+            latency=SETTINGS.get('picserv_local_latency'),
+            failure_rate=SETTINGS.get('picserv_local_failure_rate'),
+            unavailable_rate=SETTINGS.get('picserv_local_unavailable_rate'))
+    return SMBSession(address=address, username=username, password=password,
+                      server_name=server_name, service_name=service_name)
 
 
-def delete_folder(path, service_name=None, conn=None):
-    ''' delete a folder at `path` on the SMB share `service_name` '''
+class SMBSessionManager(object):
+    ''' keeps one storage backend (`SMBSession`) per server/share/creds '''
 
-    conn = conn or smb_connect()
-    conn.deleteDirectory(
-        service_name=service_name or SETTINGS.get('picserv_share'), path=path)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
 
+    def get_session(self, **kwargs):
+        session = new_backend(**kwargs)
+        with self.lock:
+            if session.key not in self.sessions:
+                self.sessions[session.key] = session
+            return self.sessions[session.key]
 
-def delete_file(path, service_name=None, conn=None):
-    ''' delete a file at `path` on the SMB share `service_name` '''
+    def close_all(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
 
-    conn = conn or smb_connect()
-    conn.deleteFiles(
-        service_name=service_name or SETTINGS.get('picserv_share'),
-        path_file_pattern=path)
 
+SESSIONS = SMBSessionManager()
 
-def copy_files(files, service_name=None, conn=None):
+
+def get_session(address=None, username=None, password=None,
+                server_name=None, service_name=None):
+    ''' shared storage backend (global settings for unspecified params) '''
+    return SESSIONS.get_session(address=address, username=username,
+                                password=password, server_name=server_name,
+                                service_name=service_name)
+
+
+def close_sessions():
+    ''' close all shared SMB sessions '''
+    SESSIONS.close_all()
+
+
+def copy_files(files, service_name=None, backend=None, dir_cache=None,
+               unchanged=None, skipped=None, on_copied=None, sources=None):
     ''' copy a list of files to `service_name`
 
         files is a list of (source_path, destitionation_path) tuples
+        all operations go through `backend` (`StorageBackend`. shared
+        SMB session by default) so a single connection is reused across
+        calls. `dir_cache` defaults to the backend's one.
+
+        if `unchanged` is set, destination folders are listed (once) and
+        files already present for which `unchanged(source_path,
+        destination_path, remote_size)` is True are not copied but
+        appended to `skipped` (list).
+
+        `on_copied(source_path, destination_path, size)` is called after
+        each successful store.
+
+        `sources` ({source_path: bytes}) holds content of source files
+        already read (not read again from disk).
 
+        raises `StorageUnavailable` if connection is lost.
         returns (success, [list, of, failures]) '''
 
-    conn = conn or smb_connect()
-    service_name = service_name or SETTINGS.get('picserv_share')
+    backend = backend or get_session(service_name=service_name)
+    dir_cache = dir_cache or backend.dir_cache
 
-    def _create_folder(service_name, path):
+    def _create(path):
         try:
-            sharedFile = conn.getAttributes(service_name=service_name,
-                                            path=path)
-            assert sharedFile.isDirectory
-        except OperationFailure:
+            backend.mkdir(path)
+        except StorageUnavailable:
+            raise
+        except StorageError:
+            # might have been created concurrently (another connection)
+            if not backend.stat(path).is_dir:
+                raise
+
+    def _create_folder(path):
+        # parent folder is listed once to know all its children
+        parent = normpath(path).rsplit('/', 1)[0] \
+            if '/' in normpath(path) else ''
+        dir_cache.list_folder(backend, parent)
+        status = dir_cache.get_status(path)
+
+        if status is not None:
+            dir_cache.avoided_stat()
+            if status == 'dir':
+                return
+            if status == 'file':
+                backend.delete(path)
+            _create(path)
+            dir_cache.add_dir(path)
+            return
+
+        try:
+            is_dir = backend.stat(path).is_dir
+        except StorageUnavailable:
+            raise
+        except StorageError:
             # does not exist, create folder
-            create_folder(path, service_name, conn)
-        except AssertionError:
-            # is not a directory. remove and recreate
-            delete_file(path, service_name, conn)
-            create_folder(path, service_name, conn)
+            _create(path)
         else:
-            # path already exist and is directory. moving on.
-            return
+            if not is_dir:
+                # is not a directory. remove and recreate
+                backend.delete(path)
+                _create(path)
+        dir_cache.add_dir(path)
 
-    def _create_folder_tree(service_name, dest_filename):
+    def _create_folder_tree(dest_filename):
         # create recursing folders on destination
         walked_folders = []
         for folder in p(dest_filename).splitall()[:-1]:
@@ -94,17 +306,52 @@ def copy_files(files, service_name=None, conn=None):
             walked_folders.append(folder)
             path = os.path.join(*walked_folders)
 
-            _create_folder(service_name, path)
+            _create_folder(path)
+
+    def _store_file(local_filename, dest_filename):
+        # write file on destination (overwrites if exists)
+        if sources and local_filename in sources:
+            local_file = io.BytesIO(sources[local_filename])
+        else:
+            local_file = open(local_filename, 'rb')
+        with local_file:
+            size = backend.store(dest_filename, local_file)
+        dir_cache.add_file(dest_filename, size)
+        return size
+
+    def _remote_size(dest_filename):
+        # single listing of the destination folder gives all sizes
+        dir_cache.list_folder(backend, p(normpath(dest_filename)).parent)
+        dir_cache.avoided_stat()
+        return dir_cache.get_size(dest_filename)
 
     failures = []
+    if skipped is None:
+        skipped = []
 
     for local_filename, dest_filename in files:
+        if unchanged is not None:
+            try:
+                remote_size = _remote_size(dest_filename)
+                if remote_size is not None and unchanged(
+                        local_filename, dest_filename, remote_size):
+                    logger.debug("Skipping unchanged `{}`"
+                                 .format(dest_filename))
+                    skipped.append((local_filename, dest_filename))
+                    continue
+            except StorageUnavailable:
+                raise
+            except Exception as exp:
+                logger.exception(exp)
+
         logger.debug("Copying `{}` to `{}`"
                      .format(local_filename, dest_filename))
 
         # create all folders up to dest_filename on samba share
         try:
-            _create_folder_tree(service_name, dest_filename)
+            _create_folder_tree(dest_filename)
+        except StorageUnavailable:
+            raise
         except Exception as exp:
             logger.debug("Unable to create folder tree for `{}`"
                          .format(dest_filename))
@@ -113,46 +360,39 @@ def copy_files(files, service_name=None, conn=None):
             continue
 
         try:
-            # write file on destination (overwrites if exists)
-            with open(local_filename, 'rb') as local_file:
-                assert conn.storeFile(
-                    service_name, dest_filename, local_file) > 0
+            size = _store_file(local_filename, dest_filename)
+            assert size > 0
+        except StorageUnavailable:
+            raise
         except Exception as exp:
-            logger.error("Unable to write {s} onto {d} on SMB {sh}"
-                         .format(s=local_filename, d=dest_filename,
-                                 sh=service_name))
+            logger.error("Unable to write {s} onto {d}"
+                         .format(s=local_filename, d=dest_filename))
             logger.exception(exp)
             failures.append((local_filename, dest_filename))
+            continue
+
+        if on_copied is not None:
+            on_copied(local_filename, dest_filename, size)
 
     return not failures, failures
 
 
 def test_connection(address=None, username=None, password=None,
                     server_name=None, service_name=None):
-    ''' test whether an SMB share is writable '''
-
-    address = address or SETTINGS.get('picserv_ip')
-    username = username or SETTINGS.get('picserv_username')
-    password = password or SETTINGS.get('picserv_password')
-    server_name = server_name or SETTINGS.get('picserv_name')
-    service_name = service_name or SETTINGS.get('picserv_share')
+    ''' test whether an SMB share (storage backend) is writable '''
 
-    # test whether server is reachable and has a samba service
-    if not test_socket(address, SAMBA_PORT):
-        return False
-
-    try:
-        conn = smb_connect(address=address,
-                           username=username, password=password,
-                           server_name=server_name)
-    except:
+    backend = get_session(address=address,
+                          username=username, password=password,
+                          server_name=server_name, service_name=service_name)
+    if not backend.is_reachable():
         return False
 
     # generate random UUID as folder name
     fname = uuid.uuid4().urn[9:]
+
     try:
-        create_folder(path=fname, service_name=service_name, conn=conn)
-        delete_folder(path=fname, service_name=service_name, conn=conn)
+        backend.mkdir(fname)
+        backend.delete(fname, folder=True)
         return True
     except:
         return False
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' storage backends images are copied to
+
+    `copy_files()` and `test_connection()` only use the `StorageBackend`
+    interface. implementations: `samba.SMBSession` (pysmb) and
+    `LocalBackend` (a local folder, for tests and benchmarks) '''
+
+import io
+import os
+import time
+import shutil
+import random
+import threading
+from collections import namedtuple
+
+from anamdesktop import logger
+
+# an item of a remote folder
+RemoteEntry = namedtuple('RemoteEntry', ['name', 'is_dir', 'size'])
+
+
+class StorageError(Exception):
+    ''' an operation failed (missing path, not permitted, etc) '''
+    pass
+
+
+class StorageUnavailable(StorageError):
+    ''' connection to storage is lost. copy can't go on '''
+    pass
+
+
+def normpath(path):
+    ''' share-relative path with `/` separators and no leading/trailing `/` '''
+    return path.replace('\\', '/').strip('/')
+
+
+class StorageBackend(object):
+    ''' remote file storage (a share) images are copied to
+
+        paths are share-relative (see `normpath()`).
+        failures raise `StorageError` or `StorageUnavailable`. '''
+
+    server_side_copy = False  # whether `copy()` runs on storage side
+
+    def __init__(self):
+        self.dir_cache = RemoteDirCache()
+
+    @property
+    def key(self):
+        ''' identifies the storage (same key: same files) '''
+        raise NotImplementedError()
+
+    def is_reachable(self):
+        ''' whether storage can be connected to '''
+        return True
+
+    def close(self):
+        pass
+
+    def mkdir(self, path):
+        ''' create folder at `path` (parent must exist) '''
+        raise NotImplementedError()
+
+    def stat(self, path):
+        ''' `RemoteEntry` of `path` '''
+        raise NotImplementedError()
+
+    def list(self, path):
+        ''' list of `RemoteEntry` in folder `path` '''
+        raise NotImplementedError()
+
+    def store(self, path, fileobj):
+        ''' write content of `fileobj` to `path` (overwrites). returns size '''
+        raise NotImplementedError()
+
+    def retrieve(self, path, fileobj):
+        ''' write content of file at `path` to `fileobj`. returns size '''
+        raise NotImplementedError()
+
+    def delete(self, path, folder=False):
+        ''' remove file (or empty `folder`) at `path` '''
+        raise NotImplementedError()
+
+    def copy(self, source, destination):
+        ''' copy file at `source` to `destination`. returns size
+
+            content is read back and stored again unless `server_side_copy` '''
+        content = io.BytesIO()
+        self.retrieve(source, content)
+        content.seek(0)
+        return self.store(destination, content)
+
+
+class RemoteDirCache(object):
+    ''' known remote directories of a share
+
+        a parent folder is listed once (list) instead of stat'ing
+        each of its children. created folders are added.
+        sizes of listed files are kept (path: size).
+        `saved` counts round trips avoided (stats avoided minus listings) '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = set([''])
+        self.files = {}
+        self.listed = set()
+        self.nb_stats_avoided = 0
+        self.nb_listings = 0
+
+    @property
+    def saved(self):
+        return self.nb_stats_avoided - self.nb_listings
+
+    def list_folder(self, backend, folder):
+        ''' list `folder` content into cache (once) '''
+        folder = normpath(folder)
+        with self.lock:
+            if folder in self.listed:
+                return
+        if folder and self.get_status(folder) == 'missing':
+            # known not to exist: nothing inside
+            with self.lock:
+                self.listed.add(folder)
+            return
+        try:
+            entries = backend.list(folder)
+        except StorageUnavailable:
+            raise
+        except StorageError:
+            entries = []
+        with self.lock:
+            self.nb_listings += 1
+            self.listed.add(folder)
+            for entry in entries:
+                path = normpath("/".join((folder, entry.name)))
+                if entry.is_dir:
+                    self.dirs.add(path)
+                else:
+                    self.files[path] = entry.size
+
+    def get_status(self, path):
+        ''' `dir`, `file`, `missing` if known, None if unknown '''
+        path = normpath(path)
+        parent = path.rsplit('/', 1)[0] if '/' in path else ''
+        with self.lock:
+            if path in self.dirs:
+                return 'dir'
+            if parent not in self.listed:
+                return None
+            return 'file' if path in self.files else 'missing'
+
+    def get_size(self, path):
+        ''' size of a listed remote file. None if unknown or missing '''
+        with self.lock:
+            return self.files.get(normpath(path))
+
+    def add_file(self, path, size):
+        with self.lock:
+            self.files[normpath(path)] = size
+
+    def avoided_stat(self):
+        with self.lock:
+            self.nb_stats_avoided += 1
+
+    def add_dir(self, path):
+        ''' record a created (thus empty) folder '''
+        path = normpath(path)
+        with self.lock:
+            self.files.pop(path, None)
+            self.dirs.add(path)
+            self.listed.add(path)
+
+
+class LocalBackend(StorageBackend):
+    ''' a local folder as storage, with injected latency and failures
+
+        lets the copy engine be tested and benchmarked without an SMB
+        server. each operation waits `latency` seconds then fails with
+        `StorageError` at `failure_rate` and `StorageUnavailable` at
+        `unavailable_rate`. '''
+
+    CHUNK_SIZE = 64 * 1024
+    server_side_copy = True
+
+    def __init__(self, root, latency=0, failure_rate=0, unavailable_rate=0):
+        super().__init__()
+        self.root = os.path.abspath(root)
+        self.latency = float(latency or 0)
+        self.failure_rate = float(failure_rate or 0)
+        self.unavailable_rate = float(unavailable_rate or 0)
+
+    @property
+    def key(self):
+        return ('local', self.root)
+
+    def is_reachable(self):
+        return os.path.isdir(self.root)
+
+    def get_path(self, path):
+        return os.path.join(self.root, *normpath(path).split('/'))
+
+    def call(self, func, *args):
+        ''' `func(*args)` after injected latency/failures '''
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.unavailable_rate:
+            raise StorageUnavailable("injected unavailability")
+        if random.random() < self.failure_rate:
+            raise StorageError("injected failure")
+        try:
+            return func(*args)
+        except OSError as exp:
+            logger.debug("Local storage: {}".format(exp))
+            raise StorageError(str(exp)) from exp
+
+    def mkdir(self, path):
+        self.call(os.mkdir, self.get_path(path))
+
+    def stat(self, path):
+        def _stat(fpath):
+            return RemoteEntry(os.path.basename(fpath), os.path.isdir(fpath),
+                               os.stat(fpath).st_size)
+        return self.call(_stat, self.get_path(path))
+
+    def list(self, path):
+        def _list(fpath):
+            with os.scandir(fpath) as entries:
+                return [RemoteEntry(entry.name, entry.is_dir(),
+                                    entry.stat().st_size)
+                        for entry in entries]
+        return self.call(_list, self.get_path(path))
+
+    def store(self, path, fileobj):
+        def _store(fpath):
+            size = 0
+            with open(fpath, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(self.CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    size += len(chunk)
+            return size
+        return self.call(_store, self.get_path(path))
+
+    def retrieve(self, path, fileobj):
+        def _retrieve(fpath):
+            size = 0
+            with open(fpath, 'rb') as f:
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    fileobj.write(chunk)
+                    size += len(chunk)
+            return size
+        return self.call(_retrieve, self.get_path(path))
+
+    def delete(self, path, folder=False):
+        self.call(os.rmdir if folder else os.remove, self.get_path(path))
+
+    def copy(self, source, destination):
+        def _copy(fpath, dest_fpath):
+            shutil.copyfile(fpath, dest_fpath)
+            return os.path.getsize(dest_fpath)
+        return self.call(_copy, self.get_path(source),
+                         self.get_path(destination))
@@ -3,6 +3,7 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 from anamdesktop import logger
+from anamdesktop.cache import get_cache
 from anamdesktop.ui.common import NA
 from anamdesktop.utils import isototext
 from anamdesktop.network import do_post
@@ -146,3 +147,6 @@ class ImportDialog(CollectActionDialog):
             return
         else:
             self.status_bar.set_success("Import terminé avec success.")
+        finally:
+            # cached dataset misses import's changes (mapping)
+            get_cache().expire(self.collect_id)
@@ -3,27 +3,15 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import threading
+from collections import Counter
 
 from PyQt5 import QtWidgets, QtCore
 
 from anamdesktop import logger
-from anamdesktop.network import do_get
+from anamdesktop.cache import get_cache
 from anamdesktop.ui.common import DialogTitle, StatusLabel
 
 
-class ActionDialogButton(QtWidgets.QPushButton):
-    ''' QPushButton storing ref to collect_id and MainWindow method to call '''
-    def __init__(self, collect_id, method, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.collect_id = collect_id
-        self.method = method
-        self.clicked.connect(self.on_click)
-
-    def on_click(self):
-        mainw = self.parent().parent().parent()
-        getattr(mainw, self.method)(self.collect_id)
-
-
 class CollectDialogInterface(object):
     ''' provides shortcut access to properties from self.dataset '''
 
@@ -34,21 +22,27 @@ class CollectDialogInterface(object):
     def nb_targets(self):
         return len(self.get_targets())
 
+    def count_targets(self, field, value):
+        ''' nb. of targets which `field` is `value`
+
+            uses counts made while loading targets from disk if any '''
+        targets = self.get_targets()
+        counts = getattr(targets, 'counts', {}).get(field)
+        if counts is None:
+            counts = Counter([target.get(field) for target in targets])
+        return counts[value]
+
     @property
     def nb_targets_male(self):
         if self.nb_targets == 0:
             return 0
-        return sum([1
-                    for target in self.get_targets()
-                    if target.get("enquete/sexe") == "masculin"])
+        return self.count_targets("enquete/sexe", "masculin")
 
     @property
     def nb_targets_female(self):
         if self.nb_targets == 0:
             return 0
-        return sum([1
-                    for target in self.get_targets()
-                    if target.get("enquete/sexe") == "feminin"])
+        return self.count_targets("enquete/sexe", "feminin")
 
     @property
     def name(self):
@@ -57,10 +51,9 @@ class CollectDialogInterface(object):
                         cercle=self.dataset.get('cercle')))
 
     def get_indigents(self):
-        return [target
-                for target in self.dataset.get('dataset', {})
-                                          .get('targets', [])]
-        #       if target.get('certificat-indigence')]
+        # now all targets (not only those with `certificat-indigence`)
+        # not copied into a list as targets might be streamed from disk
+        return self.get_targets() or []
 
     @property
     def nb_indigents(self):
@@ -102,7 +95,8 @@ class CollectActionDialog(QtWidgets.QDialog, CollectDialogInterface):
     AUTO_INITUI = True
     DOWNLOAD_DATASET = True
 
-    def __init__(self, collect_id=None, dataset=None, *args, **kwargs):
+    def __init__(self, collect_id=None, dataset=None, updated_on=None,
+                 *args, **kwargs):
 
         super().__init__(*args, **kwargs)
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
@@ -112,18 +106,26 @@ class CollectActionDialog(QtWidgets.QDialog, CollectDialogInterface):
 
         if self.DOWNLOAD_DATASET:
             assert collect_id
-            self.download_dataset(collect_id)
+            self.download_dataset(collect_id, updated_on)
         else:
             self.dataset = dataset or {}
 
         if self.AUTO_INITUI:
             self.initUI()
 
-    def download_dataset(self, collect_id):
+    def download_dataset(self, collect_id, updated_on=None):
+        ''' retrieves dataset through the local datasets cache
+
+            cached dataset is used without request if collect's
+            `updated_on` did not change.
+            targets are not loaded in memory but read from file
+            one at a time when iterated upon '''
         self.collect_id = collect_id
         logger.info("Downloading dataset for #{}".format(collect_id))
-        self.dataset = (do_get('/collects/{}'.format(self.collect_id)) or {}) \
-            .get('collect')
+        self.dataset = (get_cache().get_dataset(
+            self.collect_id, lazy=('collect', 'dataset', 'targets'),
+            count_by=('enquete/sexe',),
+            updated_on=updated_on) or {}).get('collect')
         logger.info("Dataset #{} download complete.".format(collect_id))
 
     def get_title(self):
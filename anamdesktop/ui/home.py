@@ -2,46 +2,196 @@
 # -*- coding: utf-8 -*-
 # vim: ai ts=4 sts=4 et sw=4 nu
 
+from functools import partial
 from collections import OrderedDict
 
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 
-from anamdesktop.network import do_get
 from anamdesktop.utils import isototext
-from anamdesktop.ui.table import QTable, QCellItem
-from anamdesktop.ui.dialog import ActionDialogButton
-
-
-class ArchiveToggleButton(QtWidgets.QPushButton):
-    ''' togglable QPushButton to archive/unarchive a collect
-
-        references the MainWindow which hold the actual actions
-        toggles its text and collect status '''
-
-    def __init__(self, collect_id, archived, *args, **kwargs):
-        super().__init__("", *args, **kwargs)
-        self.collect_id = collect_id
-        self.archived = archived
-        self.clicked.connect(self.on_click)
-        self.update_text()
-
-    def update_text(self):
-        self.setText("désarchiver" if self.archived else "archiver")
-
-    def on_click(self):
-        mainw = self.parent().parent().parent()
-        action = mainw.unarchive if self.archived else mainw.archive
+from anamdesktop.ui.table import QModelTable, QButtonDelegate
+
+SORT_ROLE = QtCore.Qt.UserRole + 2
+
+
+class CollectsModel(QtCore.QAbstractTableModel):
+    ''' table model of collects
+
+        cells (text, buttons state) are computed on request by the view
+        thus only for visible rows. action columns are painted as buttons
+        by a `QButtonDelegate`. '''
+
+    HEADERS = OrderedDict([
+        ('cercle', "Cercle"),
+        ('commune', "Commune"),
+        ('id', "ID"),
+        ('nb_submissions', "Enquêtés"),
+        ('started_on', "Reçu le"),
+        ('action_import', "Import"),
+        ('action_copy', "Images"),
+        ('action_archive', "Archivage"),
+    ])
+
+    CERCLE, COMMUNE, ONA_ID, NB_SUBMISSIONS, RECEIVED_ON, \
+        IMPORT, COPY, ARCHIVE = range(0, 8)
+    ACTIONS = (IMPORT, COPY, ARCHIVE)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collects = []
+        self.allow_imagesimport = False
+
+    def set_collects(self, collects):
+        ''' replace collects. if the same collects are listed (in the same
+            order), only changed rows are updated (view selection is kept) '''
+        collects = list(collects)
+        if [collect.get('id') for collect in collects] != \
+                [collect.get('id') for collect in self.collects]:
+            self.beginResetModel()
+            self.collects = collects
+            self.endResetModel()
+            return
+
+        changed = [row for row, (old, new)
+                   in enumerate(zip(self.collects, collects)) if old != new]
+        self.collects = collects
+        for row in changed:
+            self.dataChanged.emit(self.index(row, 0),
+                                  self.index(row, len(self.HEADERS) - 1))
+
+    def set_allow_imagesimport(self, allow):
+        ''' images copy allowed for all collects (only repaints buttons) '''
+        if allow == self.allow_imagesimport:
+            return
+        self.allow_imagesimport = allow
+        if self.collects:
+            self.dataChanged.emit(self.index(0, self.COPY),
+                                  self.index(len(self.collects) - 1,
+                                             self.COPY))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.collects)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal \
+                and role == QtCore.Qt.DisplayRole:
+            return list(self.HEADERS.values())[section]
+        return super().headerData(section, orientation, role)
+
+    def flags(self, index):
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        collect = self.collects[index.row()]
+        column = index.column()
+
+        if role == QtCore.Qt.DisplayRole:
+            return self.get_text(collect, column)
+        if role == QtCore.Qt.TextAlignmentRole:
+            if column == self.NB_SUBMISSIONS:
+                return QtCore.Qt.AlignCenter
+            return QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter
+        if role == QButtonDelegate.ENABLED_ROLE:
+            return self.is_enabled(collect, column)
+        if role == SORT_ROLE:
+            return self.get_sort_value(collect, column)
+        return None
+
+    def get_text(self, collect, column):
+        if column == self.CERCLE:
+            return collect.get('cercle')
+        if column == self.COMMUNE:
+            return collect.get('commune')
+        if column == self.ONA_ID:
+            return collect.get('ona_form_id')
+        if column == self.NB_SUBMISSIONS:
+            return str(collect.get('nb_submissions'))
+        if column == self.RECEIVED_ON:
+            return isototext(collect.get('started_on'))
+
+        # import button: can not import a collect already imported
+        if column == self.IMPORT:
+            if collect.get('imported'):
+                return isototext(collect.get('imported_on'))
+            return "importer"
 
-        try:
-            action(self.collect_id)
-            self.archived = not self.archived
-            self.update_text()
-        except Exception:
-            pass
+        # images copy button: highlight it's already been copied (redoable)
+        if column == self.COPY:
+            if collect.get('images_copied'):
+                return isototext(collect.get('images_copied_on'))
+            return "copier images"
+
+        if column == self.ARCHIVE:
+            return "désarchiver" if collect.get('archived', False) \
+                else "archiver"
+
+    def is_enabled(self, collect, column):
+        if column == self.IMPORT:
+            return collect.get('can_be_imported', False)
+
+        # collect must have been imported to allow images copy
+        if column == self.COPY:
+            return self.allow_imagesimport or \
+                collect.get('can_be_copied', False)
+        return True
+
+    def get_sort_value(self, collect, column):
+        if column == self.NB_SUBMISSIONS:
+            return collect.get('nb_submissions') or 0
+        field = {
+            self.CERCLE: 'cercle',
+            self.COMMUNE: 'commune',
+            self.ONA_ID: 'ona_form_id',
+            self.RECEIVED_ON: 'started_on',  # ISO 8601 sorts as text
+            self.IMPORT: 'imported_on',
+            self.COPY: 'images_copied_on',
+        }.get(column)
+        if field is None:
+            return str(collect.get('archived', False))
+        return collect.get(field) or ""
+
+
+class CollectsFilterProxy(QtCore.QSortFilterProxyModel):
+    ''' sorts collects and hides archived ones (unless displayed)
+        and those not matching the search text (cercle, commune, ID) '''
+
+    SEARCH_FIELDS = ('cercle', 'commune', 'ona_form_id')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.display_archived = False
+        self.search = ""
+        self.setSortRole(SORT_ROLE)
+        self.setSortCaseSensitivity(QtCore.Qt.CaseInsensitive)
+
+    def set_display_archived(self, display_archived):
+        if display_archived == self.display_archived:
+            return
+        self.display_archived = display_archived
+        self.invalidateFilter()
+
+    def set_search(self, text):
+        self.search = text.strip().lower()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        collect = self.sourceModel().collects[source_row]
+        if collect.get('archived', False) and not self.display_archived:
+            return False
+        if not self.search:
+            return True
+        return any([self.search in str(collect.get(field) or "").lower()
+                    for field in self.SEARCH_FIELDS])
 
 
 class HomeWidget(QtWidgets.QWidget):
-    ''' main widget representing a table-list of all collects retrieved '''
+    ''' main widget representing a table-list of all collects retrieved
+
+        built once: `refresh()` updates its model from the store '''
 
     def __init__(self, parent, *args, **kwargs):
         super().__init__(parent, *args, **kwargs)
@@ -50,22 +200,13 @@ class HomeWidget(QtWidgets.QWidget):
     def initUI(self):
         self.setSizePolicy(QtWidgets.QSizePolicy.Ignored,
                            QtWidgets.QSizePolicy.Ignored)
-        self.layout = QtWidgets.QVBoxLayout()
-
-        self.collects = (do_get('/collects', or_none=True) or {}) \
-            .get('collects')
 
-        self.content = self.create_table()
+        self.model = CollectsModel(self)
+        self.proxy = CollectsFilterProxy(self)
+        self.proxy.setSourceModel(self.model)
 
-        # display error message on connection error
-        if self.get_collects(False) is None:
-            QtWidgets.QMessageBox.warning(
-                self,
-                "Erreur d'accès aux données anam-receiver",
-                "Impossible de récupérer les données. "
-                "Vérifier les paramètres.")
-
-        self.layout.addWidget(self.content)
+        self.content = self.create_content()
+        self.refresh()
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
@@ -82,95 +223,90 @@ class HomeWidget(QtWidgets.QWidget):
         ''' shortcut to MainWindow's allow_imagesimport boolean '''
         return self.parent().allow_imagesimport
 
+    @property
+    def store(self):
+        ''' shortcut to MainWindow's collects store '''
+        return self.parent().store
+
     def get_collects(self, failsafe=True):
-        ''' filtered (archive-wise) list of retrieved collects '''
-        if self.collects is None:
-            return [] if failsafe else None
-        return [collect for collect in self.collects
-                if not collect.get('archived', False) or self.display_archived]
-
-    def create_table(self):
-        headers = OrderedDict([
-            ('cercle', "Cercle"),
-            ('commune', "Commune"),
-            ('id', "ID"),
-            ('nb_submissions', "Enquêtés"),
-            ('started_on', "Reçu le"),
-            ('action_import', "Import"),
-            ('action_copy', "Images"),
-            ('action_archive', "Archivage"),
-        ])
-
-        cercle_col, commune_col, ona_id_col, nb_sum_col, \
-            received_on_col, import_btn_col, copy_img_col, \
-            archive_btn_col = range(0, 8)
-
-        table = QTable(self, headers=headers)
+        ''' all retrieved collects (archived ones filtered by proxy) '''
+        return self.store.get_collects(display_archived=True,
+                                       failsafe=failsafe)
+
+    def refresh(self):
+        ''' update table from in-memory collects and display options '''
+        selected = self.get_selected_collect_ids()
+        self.model.set_collects(self.get_collects())
+        self.model.set_allow_imagesimport(self.allow_imagesimport)
+        self.proxy.set_display_archived(self.display_archived)
+
+        # model was reset (collects added or removed): restore selection
+        if selected and not self.table.selectionModel().hasSelection():
+            self.select_collects(selected)
+
+    def select_collects(self, collect_ids):
+        ''' select rows of collects with `collect_ids` (if displayed) '''
+        collect_ids = set(collect_ids)
+        selection = QtCore.QItemSelection()
+        for row, collect in enumerate(self.model.collects):
+            if collect.get('id') not in collect_ids:
+                continue
+            index = self.proxy.mapFromSource(self.model.index(row, 0))
+            if index.isValid():
+                selection.select(index, index)
+        self.table.selectionModel().select(
+            selection, QtCore.QItemSelectionModel.Select |
+            QtCore.QItemSelectionModel.Rows)
+
+    def get_selected_collect_ids(self):
+        ''' IDs of collects which rows are selected in the table '''
+        rows = sorted(set([self.proxy.mapToSource(index).row() for index
+                           in self.table.selectionModel().selectedRows()]))
+        return [self.model.collects[row].get('id') for row in rows]
+
+    def on_action(self, index):
+        ''' button of (proxy) `index` clicked: call MainWindow's action '''
+        collect = self.model.collects[self.proxy.mapToSource(index).row()]
+        collect_id = collect.get('id')
+        mainw = self.parent()
+
+        if index.column() == CollectsModel.IMPORT:
+            action = partial(mainw.showImportDialog, collect_id)
+        elif index.column() == CollectsModel.COPY:
+            action = partial(mainw.showImagesCopyDialog, collect_id)
+        else:
+            action = partial(mainw.unarchive if collect.get('archived', False)
+                             else mainw.archive, collect_id)
+
+        # run once the click is processed as action may reset the model
+        QtCore.QTimer.singleShot(0, action)
+
+    def create_content(self):
+        content = QtWidgets.QWidget(self)
+        layout = QtWidgets.QVBoxLayout(content)
+
+        search = QtWidgets.QLineEdit(content)
+        search.setPlaceholderText("Rechercher (cercle, commune, ID)…")
+        search.setClearButtonEnabled(True)
+        search.textChanged.connect(self.proxy.set_search)
+        layout.addWidget(search)
+
+        self.table = table = QModelTable(content)
+        table.setModel(self.proxy)
+        table.setSelectionMode(table.ExtendedSelection)
         table.setSizePolicy(
             QtWidgets.QSizePolicy(QtWidgets.QSizePolicy.Expanding,
                                   QtWidgets.QSizePolicy.Minimum))
 
-        table.setRowCount(len(self.get_collects()))
-        table.setColumnCount(len(headers))
-
-        for row_id, collect in enumerate(self.get_collects()):
-            # cercle
-            table.setItem(row_id, cercle_col, QCellItem(collect.get('cercle')))
-
-            # commune
-            table.setItem(row_id, commune_col,
-                          QCellItem(collect.get('commune')))
-
-            # ID (ona-form-id)
-            table.setItem(row_id, ona_id_col,
-                          QCellItem(collect.get('ona_form_id')))
-
-            # Nb. of submissions
-            table.setItem(row_id, nb_sum_col,
-                          QCellItem(str(collect.get('nb_submissions')),
-                                    centered=True))
-
-            # Received on (started_on)
-            table.setItem(row_id, received_on_col,
-                          QCellItem(isototext(collect.get('started_on'))))
-
-            ''' import button '''
-            import_button = ActionDialogButton(collect.get('id'),
-                                               'showImportDialog',
-                                               "importer")
-
-            # can not import a collect which has already been imported
-            if collect.get('imported'):
-                import_button.setText(isototext(collect.get('imported_on')))
-
-            import_button.setDisabled(
-                not collect.get('can_be_imported', False))
-
-            table.setCellWidget(row_id, import_btn_col, import_button)
-
-            ''' images copy button '''
-            copy_button = ActionDialogButton(collect.get('id'),
-                                             'showImagesCopyDialog',
-                                             "copier images")
-
-            # collect must have been imported to allow images copy
-            if not self.allow_imagesimport:
-                copy_button.setDisabled(
-                    not collect.get('can_be_copied', False))
-
-            # just visualy highlight that it's already been copied (redoable)
-            if collect.get('images_copied'):
-                copy_button.setText(isototext(collect.get('images_copied_on')))
-
-            table.setCellWidget(row_id, copy_img_col, copy_button)
-
-            ''' archive button '''
-            archive_button = ArchiveToggleButton(
-                collect.get('id'), collect.get('archived', False))
-
-            table.setCellWidget(row_id, archive_btn_col, archive_button)
+        # keep store order until a header is clicked
+        table.horizontalHeader().setSortIndicator(-1,
+                                                  QtCore.Qt.AscendingOrder)
+        table.setSortingEnabled(True)
 
-        # update columns adjustments
-        table.refresh()
+        self.delegate = QButtonDelegate(table)
+        self.delegate.clicked.connect(self.on_action)
+        for column in CollectsModel.ACTIONS:
+            table.setItemDelegateForColumn(column, self.delegate)
 
-        return table
+        layout.addWidget(table)
+        return content
@@ -3,14 +3,14 @@
 # vim: ai ts=4 sts=4 et sw=4 nu
 
 import os
-import json
 import shutil
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 
+from anamdesktop import jsonstream
 from anamdesktop.network import do_post
-from anamdesktop.ui.table import QTable
 from anamdesktop.ui.home import HomeWidget
+from anamdesktop.ui.store import CollectsStore
 from anamdesktop.ui.upload import UploadDialog
 from anamdesktop.ui.dbimport import ImportDialog
 from anamdesktop.ui.settings import SettingsDialog
@@ -26,7 +26,13 @@ class MainWindow(QtWidgets.QMainWindow):
         super().__init__()
         self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
         self.destroyed.connect(self.exit)
+        self.home = None
+        self.store = CollectsStore(self)
+        self.store.updated.connect(self.reset)
+        self.store.failed.connect(self.showCollectsError)
+        self.store.archived.connect(self.showArchiveErrors)
         self.initUI()
+        self.store.refresh()
 
     def initUI(self):
         self.resize(*UI_SIZE)
@@ -86,6 +92,24 @@ class MainWindow(QtWidgets.QMainWindow):
         self.toggle_imagesimport_action.setCheckable(True)
         view_menu.addAction(self.toggle_imagesimport_action)
 
+        # Collects Menu
+        collects_menu = menubar.addMenu("&Collectes")
+        refresh_action = QtWidgets.QAction("Actualiser", self)
+        refresh_action.setShortcut('F5')
+        refresh_action.triggered.connect(self.refresh)
+        collects_menu.addAction(refresh_action)
+        collects_menu.addSeparator()
+        bulk_archive_action = QtWidgets.QAction(
+            "Archiver la sélection", self)
+        bulk_archive_action.triggered.connect(
+            lambda: self.bulk_archive(archive=True))
+        collects_menu.addAction(bulk_archive_action)
+        bulk_unarchive_action = QtWidgets.QAction(
+            "Désarchiver la sélection", self)
+        bulk_unarchive_action.triggered.connect(
+            lambda: self.bulk_archive(archive=False))
+        collects_menu.addAction(bulk_unarchive_action)
+
         # Help Menu (only win)
         help_menu = menubar.addMenu("&Aide")
         about_action = QtWidgets.QAction(
@@ -106,19 +130,36 @@ class MainWindow(QtWidgets.QMainWindow):
         self.destroy()
 
     def reset(self):
-        ''' displays a new instance of Home (thus refreshing its contents) '''
-        self.displayHome()
+        ''' updates Home (displayed once) from in-memory collects '''
+        if self.home is None:
+            self.displayHome()
+            return
+        logger.info("Refreshing Home")
+        self.home.refresh()
+
+    def refresh(self):
+        ''' requests a background refresh of collects (Home updates after) '''
+        self.store.refresh()
+
+    def showCollectsError(self, silent):
+        ''' display error message on connection error (if not silent) '''
+        if silent:
+            return
+        QtWidgets.QMessageBox.warning(
+            self,
+            "Erreur d'accès aux données anam-receiver",
+            "Impossible de récupérer les données. "
+            "Vérifier les paramètres.")
 
     def switchPage(self, widget):
         ''' change content of the MainWindow to `widget` '''
         self.setCentralWidget(widget)
-        if isinstance(widget, QTable):
-            widget.resize(self.width(), self.height())
         self.show()
 
     def displayHome(self):
-        logger.info("Refreshing Home")
-        self.switchPage(HomeWidget(self).content)
+        logger.info("Displaying Home")
+        self.home = HomeWidget(self)
+        self.switchPage(self.home.content)
 
     def showAbout(self):
         QtWidgets.QMessageBox.information(
@@ -134,19 +175,26 @@ class MainWindow(QtWidgets.QMainWindow):
         settings.show()
         settings.exec_()
         logger.info("Closing Settings")
-        self.reset()  # refreshing to apply settings changes
+        self.store.refresh(full=True)  # refreshing to apply settings changes
+
+    def get_updated_on(self, collect_id):
+        ''' last update of collect as known by the store (for cache) '''
+        collect = self.store.get_collect(collect_id)
+        return collect.get('updated_on') if collect is not None else None
 
     def showImportDialog(self, collect_id):
         logger.info("Opening Import Dialog for #{}".format(collect_id))
-        ImportDialog(collect_id=collect_id).exec_()
+        ImportDialog(collect_id=collect_id,
+                     updated_on=self.get_updated_on(collect_id)).exec_()
         logger.info("Closing Import Dialog for #{}".format(collect_id))
-        self.reset()  # refreshing to apply collect's status change
+        self.refresh()  # refreshing to apply collect's status change
 
     def showImagesCopyDialog(self, collect_id):
         logger.info("Opening Copy Dialog for #{}".format(collect_id))
-        ImagesCopyDialog(collect_id=collect_id).exec_()
+        ImagesCopyDialog(collect_id=collect_id,
+                         updated_on=self.get_updated_on(collect_id)).exec_()
         logger.info("Closing Copy Dialog for #{}".format(collect_id))
-        self.reset()  # refreshing to apply collect's status change
+        self.refresh()  # refreshing to apply collect's status change
 
     def showUploadDialog(self):
         ''' displays an open file dialog to pick a json export file
@@ -162,9 +210,9 @@ class MainWindow(QtWidgets.QMainWindow):
 
         try:
             assert os.path.exists(upload_fpath)
-            with open(upload_fpath, 'r') as f:
-                dataset = json.load(f)
-            assert 'targets' in dataset
+            # incremental parse: targets are only counted, not kept
+            dataset = jsonstream.load(upload_fpath, lazy=('targets',))
+            assert isinstance(dataset.get('targets'), jsonstream.LazyArray)
         except Exception as exp:
             logger.exception(exp)
             QtWidgets.QMessageBox.warning(
@@ -178,7 +226,7 @@ class MainWindow(QtWidgets.QMainWindow):
             logger.info("Opening Upload Dialog for {}".format(upload_fpath))
             UploadDialog(dataset=dataset, fpath=upload_fpath).exec_()
             logger.info("Closing Upload Dialog for {}".format(upload_fpath))
-            self.reset()
+            self.refresh()
 
     def openHelpFile(self):
         ''' opens help file in external reader '''
@@ -211,11 +259,11 @@ class MainWindow(QtWidgets.QMainWindow):
         return self.toggle_imagesimport_action.isChecked()
 
     def toggle_archives_visibility(self, checked):
-        ''' refreshes home page's content on toggle '''
+        ''' re-filters home page's content on toggle (no network) '''
         self.reset()
 
     def toggle_images_import(self, checked):
-        ''' refreshes home page's content on toggle '''
+        ''' re-filters home page's content on toggle (no network) '''
         self.reset()
 
     def archive(self, collect_id):
@@ -224,7 +272,7 @@ class MainWindow(QtWidgets.QMainWindow):
             triggered by Home's table button '''
         try:
             do_post('/collects/{id}/archive'.format(id=collect_id))
-            self.reset()
+            self.store.update_collect(collect_id, archived=True)
         except Exception as exp:
             logger.error("Failed to archive #{}".format(collect_id))
             logger.exception(exp)
@@ -237,9 +285,31 @@ class MainWindow(QtWidgets.QMainWindow):
             triggered by Home's table button '''
         try:
             do_post('/collects/{id}/unarchive'.format(id=collect_id))
-            self.reset()
+            self.store.update_collect(collect_id, archived=False)
         except Exception as exp:
             logger.error("Failed to unarchive #{}".format(collect_id))
             logger.exception(exp)
         else:
             logger.info("Unarchived #{}".format(collect_id))
+
+    def bulk_archive(self, archive=True):
+        ''' archive (or unarchive) all selected collects at once
+
+            requests are sent in background and Home refreshed only once
+            (see `CollectsStore.archive_collects()`) '''
+        collect_ids = self.home.get_selected_collect_ids() \
+            if self.home is not None else []
+        if not collect_ids:
+            return
+        self.store.archive_collects(collect_ids, archive)
+
+    def showArchiveErrors(self, archive, failures):
+        ''' warn about collects which bulk (un)archive failed '''
+        if not failures:
+            return
+        QtWidgets.QMessageBox.warning(
+            self,
+            "Erreur d'archivage",
+            "{nb} collectes n'ont pas pu être mises à jour."
+            .format(nb=len(failures)),
+            QtWidgets.QMessageBox.Ok)
@@ -5,25 +5,35 @@
 import os
 import datetime
 
-from PyQt5 import QtWidgets
+from PyQt5 import QtWidgets, QtCore
 
-from anamdesktop import logger
+from anamdesktop import logger, SETTINGS
+from anamdesktop.cache import get_cache
 from anamdesktop.ui.common import NA
 from anamdesktop.network import do_post
 from anamdesktop.ui.dialog import CollectActionDialog
-from anamdesktop.samba import copy_files, test_connection
-from anamdesktop.utils import (
-    get_folder_name, VALID_ATTACHMENTS, isototext, open_file)
-
-import smb
+from anamdesktop.samba import test_connection
+from anamdesktop.storage import StorageUnavailable
+from anamdesktop.imagecopy import parallel_copy
+from anamdesktop.journal import get_journal, COPIED, MISSING as JMISSING
+from anamdesktop.manifest import ImageManifest
+from anamdesktop.usbscan import SourceIndex, EMPTY, CORRUPT
+from anamdesktop.utils import isototext, open_file
 
 # types of failures for image copy
 MISSING = 1
 COPYFAILED = 2
+VERIFYFAILED = 3
+EMPTYSOURCE = 4
+CORRUPTSOURCE = 5
 COPY_ERROR_TYPES = {
     MISSING: "SOURCE MANQUANTE",
     COPYFAILED: "ERREUR COPIE PARTAGE",
+    VERIFYFAILED: "COPIE NON CONFORME",
+    EMPTYSOURCE: "SOURCE VIDE",
+    CORRUPTSOURCE: "SOURCE CORROMPUE",
 }
+INTEGRITY_ERRORS = {EMPTY: EMPTYSOURCE, CORRUPT: CORRUPTSOURCE}
 
 
 class ImagesCopyDialog(CollectActionDialog):
@@ -32,9 +42,15 @@ class ImagesCopyDialog(CollectActionDialog):
     TITLE = "Copie des images"
     AUTO_INITUI = False  # we need to set source_dir first
 
+    # (nb dossiers done, status text) emitted from copy threads
+    copy_progressed = QtCore.pyqtSignal(int, str)
+
     def __init__(self, collect_id, *args, **kwargs):
         super().__init__(collect_id, *args, **kwargs)
         self.source_dir = None
+        self._manifest = None
+        self.copying = False
+        self.copy_progressed.connect(self.on_copy_progress)
         self.initUI()
 
     @property
@@ -57,24 +73,15 @@ class ImagesCopyDialog(CollectActionDialog):
         return nbp
 
     @property
-    def nb_images(self):
-        nbi = 0
-        for target in self.get_targets():
-
-            seen_ids = []
-            for attachment in target.get("_attachments"):
-                # skip other attachments
-                if attachment['labels']['slug'] not in VALID_ATTACHMENTS:
-                    continue
-
-                # skip if already copied (_hamed as duplicates)
-                if attachment['id'] in seen_ids:
-                    continue
-                else:
-                    seen_ids.append(attachment['id'])
+    def manifest(self):
+        ''' images to copy (built once, single pass over targets) '''
+        if self._manifest is None:
+            self._manifest = ImageManifest(self.get_targets(), self.mapping)
+        return self._manifest
 
-                nbi += 1
-        return nbi
+    @property
+    def nb_images(self):
+        return self.manifest.nb_images
 
     def select_source_dir(self, *args, **kwargs):
         ''' show folder picker and update `source_dir` and select_feedback '''
@@ -94,6 +101,14 @@ class ImagesCopyDialog(CollectActionDialog):
             self.source_dir if self.action_button.isEnabled()
             else "Dossier source incorrect")
 
+    def on_copy_progress(self, nb_done, text):
+        ''' update progress and status bars (in GUI thread) '''
+        # late (queued) progress must not override final status
+        if not self.copying:
+            return
+        self.progress_bar.setValue(max(nb_done, self.progress_bar.value()))
+        self.status_bar.setText(text)
+
     def open_user_log(self):
         ''' opens the images-copy-error log file in external reader '''
         open_file(self.error_log_fname)
@@ -102,7 +117,7 @@ class ImagesCopyDialog(CollectActionDialog):
         return "Copier {} images sur le partage".format(self.nb_images)
 
     def get_progress_maximum(self):
-        return self.nb_indigents
+        return self.manifest.nb_dossiers
 
     @property
     def can_be_actioned(self):
@@ -123,6 +138,10 @@ class ImagesCopyDialog(CollectActionDialog):
         self.select_button.clicked.connect(self.select_source_dir)
         self.select_feedback = QtWidgets.QLabel()
 
+        # ignore previous copies (journal, share) e.g. remote files altered
+        self.recopy_checkbox = QtWidgets.QCheckBox(
+            "ignorer les copies précédentes")
+
         return [
             ("Cercle", self.dataset.get('cercle', NA)),
             ("Commune", self.dataset.get('commune', NA)),
@@ -131,6 +150,7 @@ class ImagesCopyDialog(CollectActionDialog):
             ("Nb. personnes", str(self.nb_personnes)),
             ("Nb. images", str(self.nb_images)),
             ("Déjà copiés ?", already_copied),
+            ("Recopier tout ?", self.recopy_checkbox),
             (self.select_button, self.select_feedback),
         ]
 
@@ -139,106 +159,72 @@ class ImagesCopyDialog(CollectActionDialog):
 
         # disable folder change to prevent race condition
         self.select_button.setDisabled(True)
+        self.recopy_checkbox.setDisabled(True)
 
     def worker(self):
         ''' copy all expected images from USB folder to samba share
 
-            - loop on targets ; for each
-            - recompute original folder name
-            - compute list of expected attachment images (for whole household)
+            - loop on images of manifest (see `ImageManifest`) ; for each
             - ensure original files are present (or add to errors list)
-            - retrieve DB IDs from mapping
-            - compute new files and folders names for share
+            - ensure original files are valid images (or add to errors list)
+              rejecting the source if too many are not
 
             - ensure samba share is writable
             - copy files to samba share (failures to errors list)
+              skipping those already copied per journal (resume)
+              unless all are to be copied again (journal cleared)
+            - verify copied files (mismatches to errors list)
             - if errors not empty, write a summary in a log file
             - mark collect images copied on anam-receiver
             - display feedback '''
 
-        mappings = self.dataset.get("targets", {})
+        manifest = self.manifest
+        if manifest.invalid:
+            self.status_bar.set_error(
+                "Données manquante sur les indigents.\n"
+                "L'import est peut-être corrompu ?")
+            return
 
         error_list = []
 
-        # first prepare a full list of files to copy
-        copy_list = {}
-        for index, target in enumerate(self.get_targets()):
-            # retrieve basic information from target
-            try:
-                ident = target.get("ident")
-                logger.debug(ident)
-                mapping = mappings.get(ident)
-                dos_id = mapping.get('dossier')
-                indigent_perso_id = mapping.get('indigent')
-                first_name = target.get("enquete/prenoms")
-                last_name = target.get("enquete/nom")
-                name = "{last} {firsts}".format(
-                    last=last_name.upper(),
-                    firsts=first_name.title())
-                folder = get_folder_name(ident, last_name, first_name)
-                assert dos_id
-                assert indigent_perso_id
-                assert name
-                assert folder
-            except Exception as exp:
-                # should NEVER happen
-                logger.error("Missing indigent data in dataset")
-                logger.exception(exp)
-
-                self.status_bar.set_error(
-                    "Données manquante sur les indigents.\n"
-                    "L'import est peut-être corrompu ?")
-                return
-
-            copy_list[ident] = {'label': "{n}: {d}".format(n=name, d=dos_id),
-                                'files': []}
-
-            seen_ids = []
-            for attachment in target.get("_attachments"):
-                attach_slug = attachment['labels']['slug']
-
-                # skip other attachments
-                if attach_slug not in VALID_ATTACHMENTS:
-                    continue
+        # index files on USB (one listing per dossier folder)
+        self.status_bar.setText("Vérification des fichiers source…")
+        source = SourceIndex(self.source_dir).scan(
+            [(dossier.folder, dossier.ident)
+             for dossier in manifest.dossiers])
+
+        # check images integrity (empty, truncated) before any copy
+        if SETTINGS.get('usb_check_integrity'):
+            self.status_bar.setText("Contrôle de l'intégrité des images…")
+            integrity = source.check_integrity(
+                [(image.folder, image.fname)
+                 for dossier, image in manifest.iter_images()])
+        else:
+            integrity = {}
 
-                # skip if already copied (_hamed as duplicates)
-                if attachment['id'] in seen_ids:
-                    continue
-                else:
-                    seen_ids.append(attachment['id'])
-
-                # origin file
-                fname = attachment['export_fname']
-                fpath = os.path.join(self.source_dir, folder, fname)
-
-                # find its perso_id
-                if 'epouse' in fname or 'enfant' in fname:
-                    perso_id = mapping.get(fname.split("_", 2)[1])
-                    if 'epouse' in fname:
-                        perso_type = 'conjoint'
-                    elif 'enfant' in fname:
-                        perso_type = 'enfant'
-                else:
-                    perso_id = indigent_perso_id
-                    perso_type = 'assure'
-
-                # build destination file name and path
-                nfname = "{pid}_{ptype}_{dtype}.jpg".format(
-                    pid=perso_id, dtype=attach_slug, ptype=perso_type)
-                nfpath = "/".join([dos_id[-4:], dos_id, nfname])
-
-                # update status bar to show we're working on it
-                self.status_bar.setText("{name}: {fpath}".format(
-                    name=name, fpath=nfpath))
+        # first prepare a full list of files to copy (by dossier)
+        tasks = []
+        sizes = {}
+        for dossier in manifest.dossiers:
+            files = []
+            for image in dossier.images:
+                fpath = source.get_path(image.folder, image.fname)
 
                 # skip if the origin file is not present
-                if not os.path.exists(fpath):
-                    error_list.append((fpath, nfpath, MISSING))
+                if not source.exists(image.folder, image.fname):
+                    error_list.append((fpath, image.destination, MISSING))
+                    continue
+
+                # skip if the origin file is empty or corrupt
+                failure = integrity.get((image.folder, image.fname))
+                if failure is not None:
+                    error_list.append((fpath, image.destination,
+                                       INTEGRITY_ERRORS[failure]))
                     continue
 
-                # make sure we're not adding duplicates
-                if not (fpath, nfpath) in copy_list[ident]['files']:
-                    copy_list[ident]['files'].append((fpath, nfpath))
+                files.append((fpath, image.destination))
+                sizes[fpath] = source.get_size(image.folder, image.fname)
+            tasks.append((dossier.label, files))
 
         # check error list to fail early if the source is compromise
         if len(error_list) >= self.nb_images:
@@ -247,6 +233,19 @@ class ImagesCopyDialog(CollectActionDialog):
                 "Vérifiez la source et recommencez.")
             return
 
+        # reject source (likely a damaged USB stick) if too many bad images
+        nb_bad = len(integrity)
+        if nb_bad > self.nb_images * SETTINGS.get('usb_reject_ratio'):
+            self.write_error_log(
+                "Images corrompues sur la source de la collecte {id}."
+                .format(id=self.ona_form_id), error_list)
+            self.status_bar.set_error(
+                "{nbb} images vides ou corrompues sur {nbt}.\n"
+                "La source semble endommagée. Aucune image n'a été copiée."
+                .format(nbb=nb_bad, nbt=self.nb_images))
+            self.status_bar.on_click = self.open_user_log
+            return
+
         self.status_bar.setText("Connexion au partage…")
 
         # ensure destination is ready to fail early if not
@@ -258,31 +257,49 @@ class ImagesCopyDialog(CollectActionDialog):
 
         self.status_bar.setText("Connecté au partage.")
 
-        # start file copies from copy list
-        for index, copy_data in enumerate(copy_list.values()):
-            # update status and progress bar (copies are bundled by dossier)
-            self.progress_bar.setValue(index + 1)
-
-            copy_progress = "{label}... copie de {nb} fichiers".format(
-                label=copy_data['label'], nb=len(copy_data['files']))
-            self.status_bar.setText(copy_progress)
-
-            success = False
-            failures = []
-            try:
-                success, failures = copy_files(copy_data['files'])
-            except smb.base.SMBTimeout as exp:
-                logger.exception(exp)
-                self.status_bar.set_error(
-                    "Perte de connexion avec le partage.\n"
-                    "Vérifiez les paramètres et le réseau et recommencez.")
-                return
-            except Exception as exp:
-                logger.exception(exp)
-
-            # keep track of failed copies
-            if not success:
-                error_list += [(l, d, COPYFAILED) for l, d in failures]
+        # previous (interrupted or partial) run is resumed
+        journal = get_journal()
+        recopy = self.recopy_checkbox.isChecked()
+        if recopy:
+            logger.info("Copying all images of collect #{} again"
+                        .format(self.collect_id))
+            journal.clear(self.collect_id)
+        journal.record_many(self.collect_id, [
+            (fpath, nfpath, JMISSING, None, None)
+            for fpath, nfpath, error in error_list if error == MISSING])
+        nb_already = journal.get_summary(self.collect_id).get(COPIED, 0)
+        if nb_already:
+            logger.info("Resuming copy of collect #{}: {} images in journal"
+                        .format(self.collect_id, nb_already))
+
+        def update_progress(nb_done, nb_total, label, stats):
+            # called from copy threads (copies are bundled by dossier)
+            self.copy_progressed.emit(
+                nb_done,
+                "{label}\n{fps:.1f} fichiers/s, {mbps:.2f} Mo/s".format(
+                    label=label, fps=stats.files_per_sec,
+                    mbps=stats.mb_per_sec))
+
+        # start file copies (dossiers copied in parallel)
+        self.copying = True
+        try:
+            failures, stats = parallel_copy(
+                tasks, progress=update_progress,
+                journal=journal, collect_id=self.collect_id, sizes=sizes,
+                skip_unchanged=False if recopy else None)
+        except StorageUnavailable as exp:
+            logger.exception(exp)
+            self.status_bar.set_error(
+                "Perte de connexion avec le partage.\n"
+                "Vérifiez les paramètres et le réseau et recommencez.\n"
+                "Les images déjà copiées ne le seront pas à nouveau.")
+            return
+        finally:
+            self.copying = False
+
+        # keep track of failed copies
+        error_list += [(l, d, COPYFAILED) for l, d in failures]
+        error_list += [(l, d, VERIFYFAILED) for l, d in stats.mismatches]
 
         # copy is over
         self.progress_bar.setValue(self.progress_bar.maximum())
@@ -308,11 +325,24 @@ class ImagesCopyDialog(CollectActionDialog):
         except Exception as exp:
             logger.exception(exp)
             upload_success = False
+        finally:
+            # cached dataset misses copy's changes
+            get_cache().expire(self.collect_id)
 
         # display feedback
         if nb_errors == 0 and upload_success:
-            self.status_bar.set_success(
-                "Copie des images terminée avec succès.")
+            msg = "Copie des images terminée avec succès."
+            if stats.nb_skipped:
+                msg += "\n{nbs} images déjà présentes sur le partage." \
+                    .format(nbs=stats.nb_skipped)
+            if stats.nb_deduped:
+                msg += "\n{nbd} images en double: {mb:.1f} Mo économisés." \
+                    .format(nbd=stats.nb_deduped,
+                            mb=stats.bytes_deduped / 1024 / 1024)
+            if stats.transform is not None \
+                    and stats.transform.nb_processed:
+                msg += "\n{}.".format(stats.transform)
+            self.status_bar.set_success(msg)
         else:
             msg = "Copie partielle des images terminée.\n" \
                 "{nbe} erreurs sur {nbt} images.".format(
@@ -323,24 +353,30 @@ class ImagesCopyDialog(CollectActionDialog):
 
         # prepare a log file if partial copy
         if nb_errors:
-            with open(self.error_log_fname, 'w') as f:
-                # initial statistics
-                f.write("Copie partielle des images de la collecte {id}.{cr}"
-                        "Date de la copie: {date}.{cr}"
-                        "Nb. images: {nbt}.{cr}"
-                        "Nb. erreurs: {nbe}.{cr}{cr}".format(
-                            cr=os.linesep,
-                            id=self.ona_form_id,
-                            date=datetime.datetime.now().isoformat(),
-                            nbt=self.nb_images,
-                            nbe=nb_errors))
-
-                # list of [REASON] source -> destination lines
-                for fpath, nfpath, error in error_list:
-                    f.write("[{e}] {s} ---> {d}{cr}".format(
-                        cr=os.linesep,
-                        e=COPY_ERROR_TYPES.get(error),
-                        s=fpath, d=nfpath))
+            self.write_error_log(
+                "Copie partielle des images de la collecte {id}."
+                .format(id=self.ona_form_id), error_list)
 
             # make status bar clickable (opens log in reader)
             self.status_bar.on_click = self.open_user_log
+
+    def write_error_log(self, title, error_list):
+        ''' write `error_list` summary to the error log file '''
+        with open(self.error_log_fname, 'w') as f:
+            # initial statistics
+            f.write("{title}{cr}"
+                    "Date de la copie: {date}.{cr}"
+                    "Nb. images: {nbt}.{cr}"
+                    "Nb. erreurs: {nbe}.{cr}{cr}".format(
+                        cr=os.linesep,
+                        title=title,
+                        date=datetime.datetime.now().isoformat(),
+                        nbt=self.nb_images,
+                        nbe=len(error_list)))
+
+            # list of [REASON] source -> destination lines
+            for fpath, nfpath, error in error_list:
+                f.write("[{e}] {s} ---> {d}{cr}".format(
+                    cr=os.linesep,
+                    e=COPY_ERROR_TYPES.get(error),
+                    s=fpath, d=nfpath))
@@ -5,7 +5,7 @@
 from PyQt5 import QtWidgets, QtCore
 
 from anamdesktop.samba import test_connection
-from anamdesktop.network import test_socket, test_webservice
+from anamdesktop.network import test_socket, test_webservice, BREAKER
 from anamdesktop.oracle import ora_connect, ora_test, ORACLE_PORT
 from anamdesktop import SETTINGS, logger, save_settings, SETTINGS_FILE
 
@@ -71,6 +71,9 @@ class SettingsGroupChecker(object):
         self.check_button.setDisabled(True)
         self.change_label("vérification en cours…", 'yellow')
 
+        # explicit check: do not rely on cached reachability
+        BREAKER.reset()
+
         if self.do_check():
             logger.info("Settings OK for {}".format(self.name))
             self.change_label("paramètres OK", 'green')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import threading
+from collections import OrderedDict
+
+from PyQt5 import QtCore
+
+from anamdesktop import logger, SETTINGS
+from anamdesktop.network import do_get, do_bulk_post
+
+
+class CollectsStore(QtCore.QObject):
+    ''' in-memory list of collects retrieved from anam-receiver
+
+        refreshed in a background thread (on timer or on demand)
+        so the GUI thread never waits on the network.
+        if collects hold an `updated_on` field, only those updated since
+        last refresh are requested (merged in if response is a `delta`).
+
+        `updated` is emitted (in GUI thread) only if collects changed.
+        `failed` is emitted on refresh failure with the `silent` flag.
+        `archived` is emitted once a bulk (un)archive is over with
+        the `archive` flag and the list of collect IDs which failed. '''
+
+    updated = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(bool)
+    archived = QtCore.pyqtSignal(bool, list)
+    changed = QtCore.pyqtSignal(dict)  # `update_collects()` from a worker
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collects = None  # None until a successful retrieval
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.pending = None  # (silent, full) of refresh asked while running
+        self.changed.connect(self.update_collects)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(lambda: self.refresh(silent=True))
+        self.timer.start(
+            int(SETTINGS.get('collects_refresh_interval')) * 1000)
+
+    def get_collects(self, display_archived=False, failsafe=True):
+        ''' filtered (archive-wise) list of collects (no network) '''
+        if self.collects is None:
+            return [] if failsafe else None
+        return [collect for collect in self.collects.values()
+                if not collect.get('archived', False) or display_archived]
+
+    def get_collect(self, collect_id):
+        ''' collect with ID `collect_id` or None (no network) '''
+        if self.collects is None:
+            return None
+        return self.collects.get(collect_id)
+
+    @property
+    def last_updated_on(self):
+        if not self.collects:
+            return None
+        dates = [collect.get('updated_on')
+                 for collect in self.collects.values()]
+        if None in dates:
+            return None
+        return max(dates)
+
+    def refresh(self, silent=False, full=False):
+        ''' retrieves collects in background
+
+            if already running, one more refresh is done once it's over
+            (running one might have fetched collects before a change) '''
+        with self.lock:
+            if self.refreshing:
+                if self.pending is not None:
+                    silent = silent and self.pending[0]
+                    full = full or self.pending[1]
+                self.pending = (silent, full)
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh_worker,
+                         args=(silent, full)).start()
+
+    def refresh_worker(self, silent, full):
+        while True:
+            try:
+                self.fetch(silent, full)
+            except Exception as exp:
+                logger.exception(exp)
+                self.failed.emit(silent)
+            with self.lock:
+                if self.pending is None:
+                    self.refreshing = False
+                    return
+                (silent, full), self.pending = self.pending, None
+
+    def fetch(self, silent, full):
+        ''' retrieves collects and emits `updated` if they changed '''
+        since = None if full else self.last_updated_on
+        path = '/collects' if since is None \
+            else '/collects?updated_since={}'.format(since)
+        resp = do_get(path, or_none=True)
+        if resp is None:
+            logger.info("Unable to refresh collects list")
+            self.failed.emit(silent)
+            return
+
+        collects = OrderedDict([(collect.get('id'), collect)
+                                for collect in resp.get('collects', [])])
+        if resp.get('delta') and self.collects is not None:
+            logger.debug("Merging {} updated collects"
+                         .format(len(collects)))
+            merged = OrderedDict(self.collects)
+            merged.update(collects)
+            for collect_id in resp.get('deleted', []):
+                merged.pop(collect_id, None)
+            collects = merged
+        if collects == self.collects:
+            logger.debug("Collects list unchanged")
+            return
+        self.collects = collects
+        self.updated.emit()
+
+    def archive_collects(self, collect_ids, archive=True):
+        ''' (un)archive collects on anam-receiver in background
+
+            requests are sent concurrently. collects are updated (once)
+            before `archived` is emitted '''
+        threading.Thread(target=self.archive_worker,
+                         args=(list(collect_ids), archive)).start()
+
+    def archive_worker(self, collect_ids, archive):
+        action = "archive" if archive else "unarchive"
+        logger.info("Bulk {} of {} collects".format(action, len(collect_ids)))
+        paths = OrderedDict([('/collects/{id}/{action}'.format(
+            id=collect_id, action=action), collect_id)
+            for collect_id in collect_ids])
+
+        try:
+            results = do_bulk_post(list(paths.keys()))
+        except Exception as exp:
+            logger.exception(exp)
+            results = {path: False for path in paths.keys()}
+
+        failures = [paths[path] for path, success in results.items()
+                    if not success]
+        for collect_id in failures:
+            logger.error("Failed to {} #{}".format(action, collect_id))
+
+        # applied in GUI thread (queued) before `archived` is handled
+        self.changed.emit({paths[path]: {'archived': archive}
+                           for path, success in results.items() if success})
+        self.archived.emit(archive, failures)
+
+    def update_collect(self, collect_id, **fields):
+        ''' locally change fields of a collect (after a remote action) '''
+        self.update_collects({collect_id: fields})
+
+    def update_collects(self, updates):
+        ''' locally change fields of many collects at once
+
+            `updates` is a {collect_id: {field: value}} dict.
+            `updated` is emitted only once. '''
+        if self.collects is None:
+            return
+        collects = OrderedDict(self.collects)
+        for collect_id, fields in updates.items():
+            if collect_id in collects:
+                collects[collect_id] = dict(collects[collect_id], **fields)
+        self.collects = collects
+        self.updated.emit()
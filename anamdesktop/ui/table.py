@@ -5,11 +5,13 @@
 from PyQt5 import QtWidgets, QtCore, QtGui
 
 
-class QTable(QtWidgets.QTableWidget):
-    ''' custom design QTable (stetched, scroll) for passed headers '''
+class QModelTable(QtWidgets.QTableView):
+    ''' custom design (stretched, scroll) table view for a model
+
+        columns are stretched and rows of fixed height so that only
+        visible rows are ever computed and painted '''
 
     def __init__(self, parent, *args, **kwargs):
-        self.headers = kwargs.pop("headers")
         super().__init__(parent, *args, **kwargs)
         self.initUI()
 
@@ -18,54 +20,70 @@ class QTable(QtWidgets.QTableWidget):
         self.setAlternatingRowColors(True)
         self.setSelectionBehavior(self.SelectRows)
         self.setSelectionMode(self.SingleSelection)
-        self.refresh()
-
-    def refresh(self):
-        for index, header in enumerate(self.headers.values()):
-            self.setHorizontalHeaderItem(index, QCellHeaderItem())
+        self.setMouseTracking(True)  # buttons hover (`QButtonDelegate`)
 
-        self.setHorizontalHeaderLabels(self.headers.values())
+        font = QtGui.QFont()
+        font.setBold(True)
+        self.horizontalHeader().setFont(font)
         self.horizontalHeader().setHighlightSections(False)
         self.horizontalHeader().setVisible(True)
-        self.resizeColumnsToContents()
-
         self.horizontalHeader().setSectionResizeMode(
             self.horizontalHeader().Stretch)
+        self.verticalHeader().setSectionResizeMode(
+            self.verticalHeader().Fixed)
 
-        self.update()
 
+class QButtonDelegate(QtWidgets.QStyledItemDelegate):
+    ''' paints cells as push buttons (no widget per cell)
 
-class QCellItem(QtWidgets.QTableWidgetItem):
-    ''' custom design (alignment) QTableWidgetItem '''
+        button text is the cell's display data. button is disabled if
+        its `ENABLED_ROLE` data is False.
+        `clicked` is emitted with the cell's index on click '''
 
-    def __init__(self, *args, **kwargs):
-        self.centered = kwargs.pop('centered') \
-            if 'centered' in kwargs else False
-
-        super().__init__(*args, **kwargs)
+    ENABLED_ROLE = QtCore.Qt.UserRole + 1
 
-        self.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
-
-        if self.centered:
-            self.setTextAlignment(
-                QtCore.Qt.AlignHCenter |
-                QtCore.Qt.AlignVCenter | QtCore.Qt.AlignCenter)
-        else:
-            self.setTextAlignment(
-                QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter)
-
-
-class QCellHeaderItem(QtWidgets.QTableWidgetItem):
-    ''' custom design (font, alignment) QTableWidgetItem for headers '''
+    clicked = QtCore.pyqtSignal(QtCore.QModelIndex)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        font = QtGui.QFont()
-        font.setBold(True)
-        self.setFont(font)
-
-        self.setFlags(QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable)
-
-        self.setTextAlignment(
-            QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter |
-            QtCore.Qt.AlignCenter)
+        self.pressed = None  # (row, column) of button being pressed
+
+    def is_enabled(self, index):
+        return index.data(self.ENABLED_ROLE) is not False
+
+    def paint(self, painter, option, index):
+        button = QtWidgets.QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = index.data(QtCore.Qt.DisplayRole) or ""
+        button.state = QtWidgets.QStyle.State_Raised
+        if self.is_enabled(index):
+            button.state |= QtWidgets.QStyle.State_Enabled
+            if option.state & QtWidgets.QStyle.State_MouseOver:
+                button.state |= QtWidgets.QStyle.State_MouseOver
+            if self.pressed == (index.row(), index.column()):
+                button.state |= QtWidgets.QStyle.State_Sunken
+
+        style = option.widget.style() if option.widget is not None \
+            else QtWidgets.QApplication.style()
+        style.drawControl(QtWidgets.QStyle.CE_PushButton, button,
+                          painter, option.widget)
+
+    def editorEvent(self, event, model, option, index):
+        # mouse events on buttons do not change selection
+        if event.type() not in (QtCore.QEvent.MouseButtonPress,
+                                QtCore.QEvent.MouseButtonRelease,
+                                QtCore.QEvent.MouseButtonDblClick):
+            return False
+        if not self.is_enabled(index) \
+                or event.button() != QtCore.Qt.LeftButton:
+            return True
+
+        if event.type() == QtCore.QEvent.MouseButtonRelease:
+            pressed = self.pressed
+            self.pressed = None
+            if pressed == (index.row(), index.column()) \
+                    and option.rect.contains(event.pos()):
+                self.clicked.emit(index)
+        else:
+            self.pressed = (index.row(), index.column())
+        return True
@@ -5,11 +5,14 @@
 import os
 import datetime
 
-from anamdesktop import logger
+from PyQt5 import QtCore
+
+from anamdesktop import logger, SETTINGS
 from anamdesktop.ui.common import NA
 from anamdesktop.utils import datetotext
 from anamdesktop.ui.dialog import CollectActionDialog
-from anamdesktop.network import do_post, test_webservice
+from anamdesktop.resumable import ChunkedUpload
+from anamdesktop.network import do_upload_file, test_webservice
 
 
 class UploadDialog(CollectActionDialog):
@@ -19,9 +22,15 @@ class UploadDialog(CollectActionDialog):
     DOWNLOAD_DATASET = False
     SIZE = (350, 200)
 
+    # percentage of file sent, emitted from upload thread
+    upload_progressed = QtCore.pyqtSignal(int)
+
     def __init__(self, dataset, *args, **kwargs):
         self.fpath = kwargs.pop('fpath') if 'fpath' in kwargs else None
+        self.uploading = False
+        self.percent_sent = None
         super().__init__(dataset=dataset, *args, **kwargs)
+        self.upload_progressed.connect(self.on_upload_progress)
 
     def get_targets(self):
         ''' overriden cause our dataset is flat to ['dataset'] '''
@@ -31,7 +40,8 @@ class UploadDialog(CollectActionDialog):
         return "Transmettre cette collecte"
 
     def get_progress_maximum(self):
-        return self.nb_targets
+        # progress is bytes-level (percentage of file sent)
+        return 100
 
     @property
     def can_be_actioned(self):
@@ -50,8 +60,21 @@ class UploadDialog(CollectActionDialog):
             ("Nb. Soumissions", str(self.nb_targets)),
         ]
 
+    def update_progress(self, sent, total):
+        # called for each chunk sent: only emits when percentage changes
+        percent = sent * 100 // total if total else 100
+        if percent != self.percent_sent:
+            self.percent_sent = percent
+            self.upload_progressed.emit(percent)
+
+    def on_upload_progress(self, percent):
+        ''' update progress bar (in GUI thread) '''
+        # late (queued) progress must not override final state
+        if self.uploading:
+            self.progress_bar.setValue(percent)
+
     def worker(self):
-        ''' upload (POST) dataset to anam-receiver '''
+        ''' upload (POST) dataset file to anam-receiver (streamed) '''
 
         try:
             assert test_webservice()
@@ -62,15 +85,23 @@ class UploadDialog(CollectActionDialog):
                 "Vérifiez les paramètres.")
             return
 
+        self.uploading = True
         try:
-            do_post("/upload/", payload=self.dataset)
+            # chunked, resumable upload if enabled (upload_chunk_size)
+            if int(SETTINGS.get('upload_chunk_size') or 0):
+                ChunkedUpload(self.fpath, progress=self.update_progress).run()
+            else:
+                do_upload_file("/upload/", self.fpath,
+                               progress=self.update_progress)
         except Exception as exp:
             logger.exception(exp)
+            self.uploading = False
             self.progress_bar.setValue(self.progress_bar.maximum())
             self.status_bar.set_error(
                 "Échec de la transmission manuelle.\n"
                 "Vérifiez le fichier, le réseau et recommencez.")
         else:
+            self.uploading = False
             self.progress_bar.setValue(self.progress_bar.maximum())
             self.status_bar.set_success(
                 "Transmission manuelle terminée avec succès.")
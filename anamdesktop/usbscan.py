@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from anamdesktop import logger, SETTINGS
+
+# integrity check failures
+EMPTY = 'empty'
+CORRUPT = 'corrupt'
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+TAIL_SIZE = 1024  # some devices pad after EOI
+
+
+def normname(name):
+    ''' file name as compared by FAT32/NTFS (case-insensitive) '''
+    return name.casefold()
+
+
+def check_image(fpath, size):
+    ''' integrity failure (`EMPTY`, `CORRUPT`) of image file or None
+
+        JPEG (starting with SOI) must end with EOI: truncated otherwise.
+        other formats must have a decodable header (not checked
+        without Pillow) '''
+    if not size:
+        return EMPTY
+    try:
+        with open(fpath, 'rb') as f:
+            head = f.read(len(JPEG_SOI))
+            f.seek(max(0, size - TAIL_SIZE))
+            tail = f.read()
+    except OSError as exp:
+        logger.debug("Unable to read {}: {}".format(fpath, exp))
+        return CORRUPT
+
+    if head == JPEG_SOI:
+        return None if JPEG_EOI in tail else CORRUPT
+
+    if Image is None:
+        return None
+    try:
+        with Image.open(fpath) as image:
+            image.verify()
+    except Exception:
+        return CORRUPT
+    return None
+
+
+class SourceIndex(object):
+    ''' files present in the USB source folder, scanned in bulk
+
+        each dossier folder is listed once (`os.scandir`, in parallel
+        across folders) instead of one metadata lookup per file, which
+        is slow on FAT32 USB sticks. presence is then a dict lookup.
+
+        names are compared case-insensitively (see `normname()`) as
+        the sticks' filesystems do.
+
+        a dossier folder not found under its expected name
+        (`get_folder_name()`) but under another one starting with the
+        same `{ident}-` is used instead and listed in `mismatches`. '''
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.folders = {}  # expected folder: actual folder name or None
+        self.files = {}  # expected folder: {normname: (fname, size)}
+        self.mismatches = {}  # expected folder: actual folder name
+
+    def resolve_folders(self, folders):
+        ''' actual name of each expected folder (single listing) '''
+        try:
+            with os.scandir(self.source_dir) as entries:
+                present = [entry.name for entry in entries if entry.is_dir()]
+        except OSError as exp:
+            logger.exception(exp)
+            present = []
+        present_names = {normname(name): name for name in present}
+
+        for folder, ident in folders:
+            if normname(folder) in present_names:
+                self.folders[folder] = present_names[normname(folder)]
+                continue
+            candidates = [name for name in present
+                          if normname(name).startswith(
+                              normname("{}-".format(ident)))]
+            if len(candidates) == 1:
+                logger.warning("Folder `{}` found as `{}`"
+                               .format(folder, candidates[0]))
+                self.mismatches[folder] = candidates[0]
+                self.folders[folder] = candidates[0]
+            else:
+                self.folders[folder] = None
+
+    def scan_folder(self, folder):
+        actual = self.folders.get(folder)
+        if actual is None:
+            return folder, {}
+        try:
+            with os.scandir(os.path.join(self.source_dir, actual)) as entries:
+                return folder, {
+                    normname(entry.name): (entry.name, entry.stat().st_size)
+                    for entry in entries if entry.is_file()}
+        except OSError as exp:
+            logger.exception(exp)
+            return folder, {}
+
+    def scan(self, folders, nb_workers=None):
+        ''' index content of `folders` ([(folder, ident)]) '''
+        nb_workers = int(nb_workers or SETTINGS.get('usb_scan_workers'))
+        self.resolve_folders(folders)
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            self.files.update(executor.map(
+                self.scan_folder, [folder for folder, ident in folders]))
+        logger.info("Scanned {} folders ({} files) from {}"
+                    .format(len(folders),
+                            sum([len(files) for files in self.files.values()]),
+                            self.source_dir))
+        return self
+
+    def get_path(self, folder, fname):
+        ''' path of `fname` (actual names) in dossier folder '''
+        fname = self.files.get(folder, {}).get(normname(fname), (fname,))[0]
+        return os.path.join(self.source_dir,
+                            self.folders.get(folder) or folder, fname)
+
+    def get_size(self, folder, fname):
+        ''' size of `fname` in dossier folder. None if not present '''
+        return self.files.get(folder, {}).get(normname(fname), (None, None))[1]
+
+    def exists(self, folder, fname):
+        return self.get_size(folder, fname) is not None
+
+    def check_integrity(self, files, nb_workers=None):
+        ''' {(folder, fname): failure} of present `files` failing check
+
+            `files` is a list of (folder, fname). see `check_image()` '''
+        nb_workers = int(nb_workers or SETTINGS.get('usb_scan_workers'))
+
+        def _check(item):
+            folder, fname = item
+            return item, check_image(self.get_path(folder, fname),
+                                     self.get_size(folder, fname))
+
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            failures = {item: failure for item, failure
+                        in executor.map(_check, [
+                            item for item in files if self.exists(*item)])
+                        if failure is not None}
+        logger.info("Checked {} files: {} empty, {} corrupt".format(
+            len(files), list(failures.values()).count(EMPTY),
+            list(failures.values()).count(CORRUPT)))
+        return failures
@@ -5,8 +5,12 @@
 import os
 import sys
 import platform
+import multiprocessing
 import anamdesktop
 
+# image recompression uses a process pool (frozen executable)
+multiprocessing.freeze_support()
+
 
 def get_oraclfolder():
     if platform.system() == 'Darwin':
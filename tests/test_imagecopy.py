@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' copy engine (`parallel_copy`) against a local storage backend
+
+    run with `python -m unittest discover tests` '''
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from anamdesktop import SETTINGS
+from anamdesktop.imagecopy import parallel_copy
+from anamdesktop.journal import CopyJournal, COPIED, FAILED
+from anamdesktop.storage import StorageUnavailable
+
+SHARE = "partage_images"
+NB_DOSSIERS = 4
+NB_FILES = 12  # per dossier
+
+
+class LocalCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(SETTINGS)
+        self.source_dir = tempfile.mkdtemp()
+        self.root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.root, SHARE))
+        SETTINGS.update({'picserv_backend': 'local',
+                         'picserv_local_root': self.root,
+                         'picserv_share': SHARE,
+                         'picserv_local_failure_rate': 0,
+                         'picserv_local_unavailable_rate': 0})
+        self.journal = CopyJournal(os.path.join(self.root, 'journal.sqlite'))
+
+        # one attachment of each dossier is identical to its first one
+        self.tasks = []
+        for dossier in range(NB_DOSSIERS):
+            files = []
+            for index in range(NB_FILES):
+                fpath = os.path.join(self.source_dir,
+                                     "{}-{}.jpg".format(dossier, index))
+                with open(fpath, 'wb') as f:
+                    f.write(os.urandom(1000 + index))
+                files.append((fpath, "{d}/{d}-{i}.jpg".format(
+                    d=dossier, i=index)))
+            shutil.copyfile(files[1][0], files[0][0])
+            self.tasks.append(("dossier {}".format(dossier), files))
+
+    def tearDown(self):
+        self.journal.close()
+        SETTINGS.clear()
+        SETTINGS.update(self.settings)
+        shutil.rmtree(self.source_dir)
+        shutil.rmtree(self.root)
+
+    @property
+    def entries(self):
+        return [entry for label, files in self.tasks for entry in files]
+
+    def copy(self, **kwargs):
+        return parallel_copy(self.tasks, nb_workers=3, recompress=False,
+                             verify_sample=1, journal=self.journal,
+                             collect_id=1, **kwargs)
+
+    def assertCopied(self, entries):
+        for source, destination in entries:
+            with open(source, 'rb') as f_src, \
+                    open(os.path.join(self.root, SHARE, destination),
+                         'rb') as f_dst:
+                self.assertEqual(f_src.read(), f_dst.read(), destination)
+
+    def test_copy(self):
+        failures, stats = self.copy()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(stats.mismatches, [])
+        self.assertEqual(stats.nb_files, len(self.entries))
+        self.assertEqual(stats.nb_deduped, NB_DOSSIERS)
+        self.assertCopied(self.entries)
+        self.assertEqual(self.journal.get_summary(1),
+                         {COPIED: len(self.entries)})
+
+    def test_failures(self):
+        SETTINGS['picserv_local_failure_rate'] = 1
+        failures, stats = self.copy()
+
+        self.assertEqual(sorted(failures), sorted(self.entries))
+        self.assertEqual(stats.nb_files, 0)
+        self.assertEqual(self.journal.get_summary(1),
+                         {FAILED: len(self.entries)})
+
+    def test_unavailable(self):
+        SETTINGS['picserv_local_unavailable_rate'] = 1
+        with self.assertRaises(StorageUnavailable):
+            self.copy()
+
+    def test_resume(self):
+        random.seed(4)
+        SETTINGS['picserv_local_failure_rate'] = 0.2
+        failures, stats = self.copy()
+        self.assertTrue(failures)
+        self.assertCopied([entry for entry in self.entries
+                           if entry not in failures])
+
+        # only failed (or not verified) files are copied again
+        SETTINGS['picserv_local_failure_rate'] = 0
+        resumed_failures, resumed_stats = self.copy()
+        self.assertEqual(resumed_failures, [])
+        self.assertEqual(resumed_stats.nb_files,
+                         len(failures) + len(stats.mismatches))
+        self.assertEqual(resumed_stats.nb_files + resumed_stats.nb_skipped,
+                         len(self.entries))
+        self.assertCopied(self.entries)
+        self.assertEqual(self.journal.get_summary(1),
+                         {COPIED: len(self.entries)})
+
+    def test_recopy(self):
+        self.copy()
+        destination = os.path.join(self.root, SHARE, self.entries[5][1])
+        with open(destination, 'r+b') as f:
+            f.write(b'altered')  # same size
+
+        failures, stats = self.copy()
+        self.assertEqual(stats.nb_skipped, len(self.entries))
+
+        # journal cleared: all files are copied again
+        self.journal.clear(1)
+        failures, stats = self.copy(skip_unchanged=False)
+        self.assertEqual(failures, [])
+        self.assertEqual(stats.nb_skipped, 0)
+        self.assertCopied(self.entries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' streamed JSON decoding whatever the buffer boundaries
+
+    run with `python -m unittest discover tests` '''
+
+import io
+import os
+import json
+import tempfile
+import unittest
+
+from anamdesktop.jsonstream import StreamReader, LazyArray, load
+
+DOCUMENTS = [
+    {"a": 123.5, "b": 1},
+    {"gps": [12.6392, -8.0029, 350.0, 5], "age": 42, "montant": 1.5e+3,
+     "petit": -2.5E-7, "ok": True, "vide": None, "nom": "TRAORE"},
+    [0, -0.0, 1e10, 123, 4.25, False, "12.5"],
+    3.14159,
+]
+
+
+def decode(text, chunk_size):
+    reader = StreamReader(io.StringIO(text), chunk_size=chunk_size)
+    return reader.decode()
+
+
+def decode_items(text, chunk_size):
+    reader = StreamReader(io.StringIO(text), chunk_size=chunk_size)
+    return [reader.decode() for _ in reader.iter_array()]
+
+
+class StreamReaderTest(unittest.TestCase):
+
+    def test_chunk_sizes(self):
+        for document in DOCUMENTS:
+            for separators in ((',', ':'), (', ', ': ')):
+                text = json.dumps(document, separators=separators)
+                for chunk_size in range(1, len(text) + 2):
+                    with self.subTest(text=text, chunk_size=chunk_size):
+                        self.assertEqual(decode(text, chunk_size), document)
+
+    def test_array_items(self):
+        items = [{"lat": 12.5 + index / 7, "nb": index}
+                 for index in range(50)]
+        text = json.dumps(items)
+        for chunk_size in range(1, 64):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(decode_items(text, chunk_size), items)
+
+    def test_load_counts(self):
+        targets = [{"ident": index,
+                    "enquete/sexe": "feminin" if index % 3 else "masculin"}
+                   for index in range(30)]
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as f:
+            json.dump({"dataset": {"targets": targets}}, f)
+        self.addCleanup(os.remove, f.name)
+
+        dataset = load(f.name, lazy=('dataset', 'targets'),
+                       count_by=('enquete/sexe',))
+        targets_array = dataset['dataset']['targets']
+        self.assertIsInstance(targets_array, LazyArray)
+        self.assertEqual(len(targets_array), 30)
+        self.assertEqual(targets_array.counts['enquete/sexe']['masculin'], 10)
+        self.assertEqual(targets_array.counts['enquete/sexe']['feminin'], 20)
+        self.assertEqual(list(targets_array), targets)
+
+
+if __name__ == '__main__':
+    unittest.main()
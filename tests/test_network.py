@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ai ts=4 sts=4 et sw=4 nu
+
+''' compressed transfers against the local stand-in receiver
+
+    run with `python -m unittest discover tests` '''
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from anamdesktop import SETTINGS, jsonstream
+from anamdesktop.network import do_post, do_download, get_endpoint
+from anamdesktop.fakereceiver import start_receiver
+
+BANDWIDTH = 512 * 1024  # bytes per second (field link)
+NB_TARGETS = 2000
+
+
+def get_targets():
+    return [{'ident': "T{:05d}".format(index),
+             'enquete/nom': "TRAORE",
+             'enquete/prenoms': "Aminata",
+             'enquete/sexe': "feminin",
+             'enquete/commune': "Bamako Commune {}".format(index % 6)}
+            for index in range(NB_TARGETS)]
+
+
+class CompressedTransferTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fixtures_dir = tempfile.mkdtemp()
+        collect = {'id': 1, 'ona_form_id': "enquete-1", 'cercle': "Kati",
+                   'commune': "Kati", 'targets': get_targets()}
+        with open(os.path.join(cls.fixtures_dir, 'collects.json'), 'w') as f:
+            json.dump([{key: value for key, value in collect.items()
+                        if key != 'targets'}], f)
+        with open(os.path.join(cls.fixtures_dir, 'collect-1.json'), 'w') as f:
+            json.dump(collect, f)
+
+        cls.server = start_receiver(fixtures_dir=cls.fixtures_dir,
+                                    token="token", bandwidth=BANDWIDTH)
+        cls.settings = dict(SETTINGS)
+        SETTINGS.update({'store_url': cls.server.url, 'store_token': "token"})
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        SETTINGS.clear()
+        SETTINGS.update(cls.settings)
+        shutil.rmtree(cls.fixtures_dir)
+
+    def setUp(self):
+        with self.server.state.lock:
+            self.server.state.stats.update({'bytes_in': 0, 'bytes_out': 0})
+            self.server.state.uploads.clear()
+
+    def upload(self, level):
+        ''' (bytes on the wire, seconds) to post an export at gzip `level` '''
+        SETTINGS['store_gzip_level'] = level
+        self.setUp()
+        payload = {'ona_form_id': "enquete-1", 'targets': get_targets()}
+        started_on = time.monotonic()
+        do_post('/upload/', payload=payload)
+        duration = time.monotonic() - started_on
+        self.assertEqual(self.server.state.uploads, [payload])
+        return self.server.state.stats['bytes_in'], duration
+
+    def test_upload_compressed(self):
+        raw_bytes, raw_duration = self.upload(0)
+        gz_bytes, gz_duration = self.upload(6)
+
+        self.assertEqual(raw_bytes, len(json.dumps(
+            {'ona_form_id': "enquete-1", 'targets': get_targets()})))
+        self.assertLess(gz_bytes, raw_bytes / 10)
+        self.assertLess(gz_duration, raw_duration / 2)
+
+    def test_download_compressed(self):
+        fpath = os.path.join(self.fixtures_dir, 'download.json')
+        resp = do_download('/collects/1', fpath, lazy=('collect', 'targets'))
+
+        self.assertEqual(len(resp['collect']['targets']), NB_TARGETS)
+        self.assertEqual(list(jsonstream.iter_items(
+            fpath, ('collect', 'targets')))[-1], get_targets()[-1])
+        self.assertLess(self.server.state.stats['bytes_out'],
+                        os.path.getsize(fpath) / 10)
+
+    def test_post_without_payload(self):
+        do_post('/collects/1/archive')
+        self.assertEqual(self.server.state.stats['bytes_in'], 0)
+        self.assertTrue(self.server.state.collects['1']['archived'])
+
+
+class EndpointTest(unittest.TestCase):
+
+    def test_ids_replaced(self):
+        self.assertEqual(get_endpoint('POST', '/collects/12/mark_imported'),
+                         "POST /collects/{id}/mark_imported")
+        self.assertEqual(
+            get_endpoint('POST', '/upload/chunked/3f63ba09e8640b4a/parts/7'),
+            "POST /upload/chunked/{id}/parts/{id}")
+        self.assertEqual(get_endpoint('GET', '/collects?updated_since=2017'),
+                         "GET /collects")
+
+    def test_partial_segments_kept(self):
+        self.assertEqual(get_endpoint('GET', '/collects/12a'),
+                         "GET /collects/12a")
+        self.assertEqual(get_endpoint('POST', '/upload/chunked/'),
+                         "POST /upload/chunked/")
+
+
+if __name__ == '__main__':
+    unittest.main()